@@ -0,0 +1,197 @@
+# coding: utf-8
+"""Vectorized analytics over GymLog, Gym and GymMember.
+
+Each table is loaded with a single query into NumPy column arrays (timestamps are parsed by NumPy
+as datetime64[s], gyms and trainers are mapped to integer indexes) and every metric is computed
+with array operations, without per-row Python loops. Results are plain dicts and lists, ready to
+be rendered by the bot or returned as json by the web server.
+
+Timestamps are the naive local datetimes stored by the scanner, so they are handled as such.
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from peewee import fn
+
+from models import Gym, GymLog, GymMember, TEAMS, init_database
+
+log = logging.getLogger(__name__)
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+# Bounds of summary(): team_control() builds gyms x time steps arrays
+MAX_DAYS = 90
+MAX_STEPS = 1000
+
+
+def fetch_columns(query, count):
+    """Runs a query and returns its `count` columns as lists (raw SQLite values, no peewee conversion)."""
+    rows = init_database().execute_sql(*query.sql()).fetchall()
+    if not rows:
+        return [[] for _ in range(count)]
+    return [list(column) for column in zip(*rows)]
+
+
+def to_seconds(timestamps):
+    return np.array(timestamps, dtype='datetime64[us]').astype('datetime64[s]').astype(np.int64)
+
+
+def to_datetime(seconds):
+    return np.int64(seconds).astype('datetime64[s]').item()
+
+
+class CityData(object):
+    """Column arrays of the gyms, of the conquests since `start` and of the membership events in [start, end)."""
+
+    def __init__(self, start, end=None):
+        self.start = start
+        self.end = end or datetime.now()
+        self.start_s = to_seconds([start])[0]
+        self.end_s = to_seconds([self.end])[0]
+        self._load_gyms()
+        self._load_conquests()
+        self._load_members()
+
+    def gym_index(self, gym_ids):
+        """Positions of the gyms in self.gym_ids, and a mask of the ones found there."""
+        gym_ids = np.array(gym_ids, dtype=np.unicode_)
+        idx = np.searchsorted(self.gym_ids, gym_ids)
+        found = idx < len(self.gym_ids)
+        found[found] = self.gym_ids[idx[found]] == gym_ids[found]
+        return idx, found
+
+    def _load_gyms(self):
+        ids, names, teams = fetch_columns(Gym.select(Gym.id, Gym.name, Gym.team_id).order_by(Gym.id), 3)
+        self.gym_ids = np.array(ids, dtype=np.unicode_)
+        self.gym_names = np.array(names, dtype=object)
+        self.gym_teams = np.array(teams, dtype=np.int8)
+
+    def _load_conquests(self):
+        # Conquests up to now, not only up to the end: the first one after the window tells the
+        # team that held the gym during it
+        query = (GymLog.select(GymLog.gym, GymLog.timestamp, fn.COALESCE(GymLog.old_team_id, -1), GymLog.team_id)
+                 .where((GymLog.action == GymLog.GYM_CONQUESTED) & (GymLog.timestamp >= self.start))
+                 .order_by(GymLog.gym, GymLog.timestamp))
+        gyms, timestamps, old_teams, teams = fetch_columns(query, 4)
+        # Rows of gyms missing from Gym would be counted for their neighbour in the sorted ids
+        gym_idx, known = self.gym_index(gyms)
+        self.conquest_gym = gym_idx[known].astype(np.int64)
+        self.conquest_time = to_seconds(timestamps)[known]
+        self.conquest_old_team = np.array(old_teams, dtype=np.int8)[known]
+        self.conquest_team = np.array(teams, dtype=np.int8)[known]
+
+    def _load_members(self):
+        query = (GymLog.select(GymLog.trainer, GymLog.timestamp)
+                 .where((GymLog.action == GymLog.NEW_GYM_MEMBER) &
+                        (GymLog.timestamp >= self.start) & (GymLog.timestamp < self.end)))
+        trainers, timestamps = fetch_columns(query, 2)
+        current_trainers, = fetch_columns(GymMember.select(GymMember.trainer), 1)
+        self.trainer_names, inverse = np.unique(np.array(trainers + current_trainers, dtype=np.unicode_),
+                                                return_inverse=True)
+        self.member_trainer = inverse[:len(trainers)]
+        self.member_time = to_seconds(timestamps)
+        self.current_trainer = inverse[len(trainers):]
+
+    def initial_teams(self):
+        """Team of each gym at the start of the window."""
+        teams = self.gym_teams.copy()
+        first = np.ones(len(self.conquest_gym), dtype=bool)
+        first[1:] = self.conquest_gym[1:] != self.conquest_gym[:-1]
+        known = first & (self.conquest_old_team >= 0)
+        teams[self.conquest_gym[known]] = self.conquest_old_team[known]
+        return teams
+
+    def teams_at(self, times):
+        """Team of every gym at each of the times (seconds): array of shape (gyms, times)."""
+        gyms = np.arange(len(self.gym_ids))
+        initial = self.initial_teams()
+        if not len(self.conquest_gym):
+            return np.repeat(initial[:, None], len(times), axis=1)
+        # Conquests are sorted by gym and time, so gym * span + time is sorted too
+        origin = min(self.start_s, times.min())
+        span = max(self.conquest_time.max(), times.max()) - origin + 1
+        keys = self.conquest_gym * span + (self.conquest_time - origin)
+        queries = gyms[:, None] * span + (times - origin)[None, :]
+        idx = np.searchsorted(keys, queries, side='right') - 1
+        found = np.clip(idx, 0, None)
+        same_gym = (idx >= 0) & (self.conquest_gym[found] == gyms[:, None])
+        return np.where(same_gym, self.conquest_team[found], initial[:, None])
+
+    def team_control(self, step=HOUR):
+        """Share of the gyms controlled by each team, sampled every `step` seconds."""
+        times = np.arange(self.start_s, self.end_s, step)
+        teams = self.teams_at(times)
+        total = float(max(len(self.gym_ids), 1))
+        return {
+            'times': times.astype('datetime64[s]').tolist(),
+            'shares': dict((name, ((teams == team_id).sum(axis=0) / total).tolist())
+                           for team_id, name in enumerate(TEAMS)),
+        }
+
+    def _window_conquests(self):
+        return self.conquest_time < self.end_s
+
+    def flip_rates(self, top=10):
+        """Gyms that change owner most often, in flips per day."""
+        in_window = self._window_conquests()
+        flips = np.bincount(self.conquest_gym[in_window], minlength=len(self.gym_ids))
+        days = max(float(self.end_s - self.start_s) / DAY, 1.0 / 24)
+        order = np.argsort(-flips, kind='mergesort')[:top]
+        return [{'id': self.gym_ids[idx], 'name': self.gym_names[idx], 'flips': int(flips[idx]),
+                 'flips_per_day': flips[idx] / days} for idx in order if flips[idx]]
+
+    def hold_durations(self):
+        """Mean seconds each team holds a gym, from the holds started and ended inside the window."""
+        in_window = self._window_conquests()
+        gym = self.conquest_gym[in_window]
+        times = self.conquest_time[in_window]
+        holder = self.conquest_team[in_window]
+        consecutive = gym[1:] == gym[:-1]
+        durations = (times[1:] - times[:-1])[consecutive]
+        holders = holder[:-1][consecutive].astype(np.int64)
+        counts = np.bincount(holders, minlength=len(TEAMS))
+        totals = np.bincount(holders, weights=durations, minlength=len(TEAMS))
+        return dict((name, {'holds': int(counts[team_id]),
+                            'mean_seconds': totals[team_id] / counts[team_id] if counts[team_id] else None})
+                    for team_id, name in enumerate(TEAMS))
+
+    def trainer_activity(self, top=10):
+        """Most active trainers (pokemon placed in gyms), with the hours of the day they play the most."""
+        trainers = len(self.trainer_names)
+        hours = (self.member_time % DAY) // HOUR
+        by_hour = np.bincount(self.member_trainer * 24 + hours, minlength=trainers * 24).reshape(trainers, 24)
+        events = by_hour.sum(axis=1)
+        first_seen = np.full(trainers, np.iinfo(np.int64).max, dtype=np.int64)
+        last_seen = np.full(trainers, np.iinfo(np.int64).min, dtype=np.int64)
+        np.minimum.at(first_seen, self.member_trainer, self.member_time)
+        np.maximum.at(last_seen, self.member_trainer, self.member_time)
+        gyms = np.bincount(self.current_trainer, minlength=trainers)
+        peak_hours = np.argsort(-by_hour, axis=1, kind='mergesort')[:, :3]
+        order = np.argsort(-events, kind='mergesort')[:top]
+        return [{'name': self.trainer_names[idx], 'events': int(events[idx]), 'gyms': int(gyms[idx]),
+                 'first_seen': to_datetime(first_seen[idx]), 'last_seen': to_datetime(last_seen[idx]),
+                 'peak_hours': sorted(int(hour) for hour in peak_hours[idx] if by_hour[idx, hour])}
+                for idx in order if events[idx]]
+
+
+def valid_range(days, step):
+    """Whether summary() can be asked for `days` sampled every `step` seconds."""
+    return 0 < days <= MAX_DAYS and step > 0 and days * DAY / step <= MAX_STEPS
+
+
+def summary(days=30, step=HOUR, top=10):
+    if not valid_range(days, step):
+        raise ValueError("Up to {} days and {} time steps".format(MAX_DAYS, MAX_STEPS))
+    start_time = time.time()
+    data = CityData(datetime.now() - timedelta(days=days))
+    result = {
+        'days': days,
+        'team_control': data.team_control(step),
+        'flip_rates': data.flip_rates(top),
+        'hold_durations': data.hold_durations(),
+        'trainer_activity': data.trainer_activity(top),
+    }
+    log.info("Analytics of {} days computed in {:.2f}s".format(days, time.time() - start_time))
+    return result
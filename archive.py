@@ -0,0 +1,140 @@
+# coding: utf-8
+import bisect
+import json
+import logging
+import os
+import re
+import struct
+import time
+import zlib
+
+from config import ARCHIVE_DIR, ARCHIVE_SEGMENT_SIZE
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_PATH = os.path.join(os.path.dirname(__file__), ARCHIVE_DIR)
+SEGMENT_PATTERN = re.compile(r'^segment-(\d{6})\.log$')
+# timestamp_ms, offset, length, len(gym_id) + gym_id
+INDEX_ENTRY = struct.Struct('>QQIB')
+
+
+def segment_path(path, segment):
+    return os.path.join(path, 'segment-{:06d}.log'.format(segment))
+
+
+def index_path(path, segment):
+    return os.path.join(path, 'segment-{:06d}.idx'.format(segment))
+
+
+def read_index(idx_file):
+    with open(idx_file, 'rb') as fp:
+        data = fp.read()
+    position = 0
+    while position + INDEX_ENTRY.size <= len(data):
+        timestamp_ms, offset, length, id_length = INDEX_ENTRY.unpack_from(data, position)
+        position += INDEX_ENTRY.size
+        gym_id = data[position:position + id_length]
+        if len(gym_id) < id_length:  # Truncated entry
+            break
+        position += id_length
+        yield gym_id, timestamp_ms, offset, length
+
+
+class ResponseArchive(object):
+    """Append-only archive of raw GET_GYM_DETAILS responses.
+
+    Each response is compressed on its own and appended to the current segment file, which is
+    rotated once it reaches segment_size bytes. A small index per segment (gym id, timestamp,
+    offset, length) is loaded in memory so any gym's history can be read without decompressing
+    whole segments.
+    """
+
+    def __init__(self, path=ARCHIVE_PATH, segment_size=ARCHIVE_SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.index = {}  # gym_id -> sorted list of (timestamp_ms, segment, offset, length)
+        self.segment = 0
+        self.data_file = None
+        self.index_file = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        segments = sorted(int(match.group(1)) for match in
+                          (SEGMENT_PATTERN.match(name) for name in os.listdir(path)) if match)
+        for segment in segments:
+            if os.path.exists(index_path(path, segment)):
+                for gym_id, timestamp_ms, offset, length in read_index(index_path(path, segment)):
+                    self._add_to_index(gym_id, (timestamp_ms, segment, offset, length))
+        self._open_segment(segments[-1] if segments else 1)
+        log.info("Opened archive {} ({} segments, {} gyms)".format(path, len(segments), len(self.index)))
+
+    def _add_to_index(self, gym_id, entry):
+        entries = self.index.setdefault(gym_id, [])
+        if entries and entries[-1][0] > entry[0]:
+            bisect.insort(entries, entry)
+        else:
+            entries.append(entry)
+
+    def _open_segment(self, segment):
+        self.close()
+        self.segment = segment
+        self.data_file = open(segment_path(self.path, segment), 'ab')
+        self.index_file = open(index_path(self.path, segment), 'ab')
+
+    def append(self, gym_id, gym_detail, timestamp_ms=None):
+        if timestamp_ms is None:
+            timestamp_ms = int(time.time() * 1000)
+        if self.data_file.tell() >= self.segment_size:
+            self._open_segment(self.segment + 1)
+
+        gym_id = gym_id.encode('utf-8') if isinstance(gym_id, unicode) else gym_id
+        record = zlib.compress(json.dumps(gym_detail, separators=(',', ':')))
+        offset = self.data_file.tell()
+        self.data_file.write(record)
+        self.index_file.write(INDEX_ENTRY.pack(timestamp_ms, offset, len(record), len(gym_id)) + gym_id)
+        self._add_to_index(gym_id, (timestamp_ms, self.segment, offset, len(record)))
+
+    def append_many(self, responses, timestamp_ms=None):
+        """Appends (gym_id, gym_detail) pairs and flushes them to disk."""
+        for gym_id, gym_detail in responses:
+            self.append(gym_id, gym_detail, timestamp_ms)
+        self.flush()
+
+    def flush(self):
+        self.data_file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        for fp in (self.data_file, self.index_file):
+            if fp is not None:
+                fp.close()
+        self.data_file = self.index_file = None
+
+    def _read(self, entries):
+        self.flush()
+        handles = {}
+        try:
+            for timestamp_ms, segment, offset, length in entries:
+                if segment not in handles:
+                    handles[segment] = open(segment_path(self.path, segment), 'rb')
+                handles[segment].seek(offset)
+                yield timestamp_ms, json.loads(zlib.decompress(handles[segment].read(length)))
+        finally:
+            for fp in handles.values():
+                fp.close()
+
+    def history(self, gym_id, start_ms=None, end_ms=None):
+        """Yields (timestamp_ms, gym_detail) for the responses of a gym between start_ms and end_ms."""
+        entries = self.index.get(gym_id, [])
+        first = bisect.bisect_left(entries, (start_ms,)) if start_ms is not None else 0
+        last = bisect.bisect_right(entries, (end_ms, float('inf'))) if end_ms is not None else len(entries)
+        return self._read(entries[first:last])
+
+    def responses(self, start_ms=None, end_ms=None):
+        """Yields (timestamp_ms, gym_detail) for every archived response in order, to reprocess them."""
+        entries = []
+        for gym_id in self.index:
+            entries.extend(entry for entry in self.index[gym_id]
+                           if (start_ms is None or entry[0] >= start_ms) and (end_ms is None or entry[0] <= end_ms))
+        entries.sort(key=lambda entry: (entry[1], entry[2]))  # Read segments sequentially
+        return self._read(entries)
@@ -0,0 +1,80 @@
+# coding: utf-8
+"""Ingest benchmark: replays synthetic scan cycles through the ingest pipeline and reports
+throughput, time per stage and database growth."""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from city_state import CityState
+from models import create_tables, use_database
+from replay import replay
+from synthetic import SyntheticCity
+
+STAGES = ['parse', 'diff', 'write']
+
+
+def database_size(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+
+def run(gyms_count, cycles, churn, batch_size, database, seed=0):
+    use_database(database)
+    create_tables()
+    state = CityState.load()
+    city = SyntheticCity(gyms_count, seed=seed)
+
+    print "{:>5} {:>8} {:>9} {:>8} {:>8} {:>8} {:>10} {:>9}".format(
+        "CYCLE", "CHANGED", "GYMS/S", "PARSE", "DIFF", "WRITE", "DB SIZE", "GROWTH")
+    results = []
+    last_size = database_size(database)
+    for cycle in range(cycles + 1):
+        changed = city.step(churn=churn) if cycle > 0 else city.gyms.keys()
+        timings = {}
+        start = time.time()
+        count, _ = replay(city.gym_details(), state, batch_size, timings)
+        elapsed = time.time() - start
+
+        size = database_size(database)
+        results.append((count / elapsed if elapsed else 0, timings, size - last_size))
+        print "{:5} {:8} {:9.1f} {:7.3f}s {:7.3f}s {:7.3f}s {:9.1f}K {:+8.1f}K".format(
+            cycle, len(changed), results[-1][0], timings.get('parse', 0), timings.get('diff', 0),
+            timings.get('write', 0), size / 1024.0, (size - last_size) / 1024.0)
+        last_size = size
+
+    steady = results[1:] or results
+    print "-" * 70
+    print "Mean gyms/s (changing cycles): {:.1f}".format(sum(r[0] for r in steady) / len(steady))
+    for stage in STAGES:
+        print "Mean {:5}: {:.4f}s".format(stage, sum(r[1].get(stage, 0) for r in steady) / len(steady))
+    print "Mean DB growth per cycle: {:.1f}K".format(sum(r[2] for r in steady) / len(steady) / 1024.0)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--gyms', type=int, default=1000)
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--churn', type=float, default=0.1, help="fraction of gyms changed per cycle")
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', help="SQLite file to use (default: temporary file)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    tmp_dir = None
+    database = args.database
+    if database is None:
+        tmp_dir = tempfile.mkdtemp(prefix='benchmark')
+        database = os.path.join(tmp_dir, 'benchmark.sqlite')
+    try:
+        run(args.gyms, args.cycles, args.churn, args.batch_size, database, args.seed)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,18 @@
 # coding: utf-8
 import logging
-from collections import Counter
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
-import telebot
-from peewee import DoesNotExist
-
+import analytics
 import models
-from config import BOT_API_TOKEN
-from models import Trainer
+from bot_workers import PooledTeleBot, use_api_url, webhook_server
+from config import BOT_API_TOKEN, BOT_CACHE_SIZE, BOT_API_URL, BOT_WEBHOOK_PORT, BOT_WEBHOOK_PATH, \
+    BOT_WEBHOOK_URL, AREA_RADIUS
+from livestate import LiveStateReader
+from notifications import Subscriptions, Notifier, gyms_in_area, GYM, TRAINER, AREA
+from profiler import profiled
+from trainer_search import TrainerIndex
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(module)10s] [%(levelname)5s] %(message)s')
@@ -40,8 +44,72 @@ TEAM_EMOJI = [GRAY_CIRCLE, BLUE_HEART, RED_HEART, YELLOW_HEART]
 
 CHEATERS_FILE = "cheaters.txt"
 CHEATERS = set()
-
-bot = telebot.TeleBot(BOT_API_TOKEN)
+# Longest message text accepted by Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+
+class ResponseCache(object):
+    """Rendered answers of the commands for one version of the live state (LiveState.version).
+
+    Answers depend only on the published data, so they are rendered once per version, however
+    many chats ask for them, and dropped when the scanner publishes a newer one. Per-trainer
+    answers make the keys unbounded, so at most max_entries are kept (least recently used first out).
+    """
+
+    def __init__(self, max_entries=BOT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.version = None
+        self.entries = OrderedDict()
+        self.key_locks = {}
+        self.lock = threading.Lock()
+
+    def _lookup(self, key, version):
+        """Must be called with the lock held. Returns (found, value)."""
+        if self.version is None or version > self.version:
+            self.version = version
+            self.entries.clear()
+            self.key_locks.clear()
+        if version != self.version or key not in self.entries:
+            return False, None
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return True, value
+
+    def get(self, key, version, render):
+        with self.lock:
+            found, value = self._lookup(key, version)
+            if found:
+                return value
+            stale = version != self.version
+            if not stale:
+                key_lock = self.key_locks.setdefault(key, threading.Lock())
+        # Requests still holding an older live state are answered without touching the cache
+        if stale:
+            return render()
+        # Requests arriving while the answer is rendered wait for it instead of rendering it again
+        with key_lock:
+            with self.lock:
+                found, value = self._lookup(key, version)
+                if found:
+                    return value
+            value = render()
+            with self.lock:
+                if version == self.version:
+                    self.entries[key] = value
+                    while len(self.entries) > self.max_entries:
+                        evicted, _ = self.entries.popitem(last=False)
+                        self.key_locks.pop(evicted, None)
+        return value
+
+
+# Handlers run concurrently across chats, in order within each chat (see bot_workers.py)
+bot = PooledTeleBot(BOT_API_TOKEN)
+# Current gyms, members and trainers, published by the scanner
+live_state = LiveStateReader()
+response_cache = ResponseCache()
+trainer_index = TrainerIndex()
+# Gyms, trainers and areas followed by each chat
+subscriptions = Subscriptions()
 
 
 def load_cheaters(txt_file):
@@ -57,6 +125,13 @@ def prepare_text(text):
     return "```\n{}\n```".format(text)
 
 
+def get_live_state(message):
+    state = live_state.get()
+    if state is None:
+        bot.reply_to(message, "Todavía no hay datos de los gimnasios")
+    return state
+
+
 # Handle '/start' and '/help'
 @bot.message_handler(commands=['help', 'start'])
 def send_welcome(message):
@@ -67,35 +142,26 @@ Tengo información interesante sobre el estado de los gimnasios y los entrenador
 """)
 
 
-@bot.message_handler(commands=['equipos'])
-def gyms_by_team(message):
-    log.debug("/equipos " + str(message.chat.__dict__))
-    updated_time = list(models.Gym.select().order_by(models.Gym.last_checked.desc()).limit(1))[0].last_checked
-    gyms = models.Gym.select()
-    team_counter = Counter([gym.team_id for gym in gyms])
+def render_gyms_by_team(state):
+    team_counter = dict((team_id, gyms) for team_id, gyms in enumerate(state.team_counts) if gyms)
     total_gyms = sum(team_counter.values())
     response = ""
     response += "Gimnasios por equipos\n"
     response += "-" * 25 + "\n"
-    response += "Total de gimnasios: {}\n".format(models.Gym.select().count())
+    response += "Total de gimnasios: {}\n".format(total_gyms)
     teams = team_counter.items()
     teams = sorted(teams, key=lambda x: x[1], reverse=True)
     for team_id, gyms_owned in teams:
         team_emoji = TEAM_EMOJI[team_id].encode('utf-8')
         response += "{}{:8} {:5}  ({:.1f}%)\n".format(team_emoji, models.TEAMS[team_id], gyms_owned,
                                                       gyms_owned / float(total_gyms) * 100)
-    response += "Fecha: {}".format(updated_time.strftime('%H:%M %d/%m/%Y'))
-
-    bot.reply_to(message, prepare_text(response), parse_mode="Markdown")
+    response += "Fecha: {}".format(state.published.strftime('%H:%M %d/%m/%Y'))
+    return prepare_text(response)
 
 
-@bot.message_handler(commands=['top_entrenadores'])
-def top_trainers(message):
-    log.debug("/top_entrenadores " + str(message.chat.__dict__))
-    updated_time = list(models.Trainer.select().order_by(models.Trainer.last_checked.desc()).limit(1))[0].last_checked
-    top_trainers = models.Trainer.sorted_by_level()
-    top_trainers_withouth_cheaters = [trainer for trainer in top_trainers if trainer.name not in CHEATERS
-                                      if trainer.last_checked > datetime.now() + timedelta(days=-15)]
+def render_top_trainers(state):
+    top_trainers_withouth_cheaters = state.top_trainers(15, exclude=CHEATERS,
+                                                        since=datetime.now() + timedelta(days=-15))
 
     response = ""
     response += "TOP 15 entrenadores de los últimos 15 días\n"
@@ -104,18 +170,15 @@ def top_trainers(message):
     for trainer in top_trainers_withouth_cheaters[:15]:
         team_emoji = TEAM_EMOJI[trainer.team_id].encode('utf-8')
         response += "{:^5} {}{:16} \n".format(trainer.level, team_emoji, trainer.name)
-    response += "Fecha: {}".format(updated_time.strftime('%H:%M %d/%m/%Y'))
+    response += "Fecha: {}".format(state.published.strftime('%H:%M %d/%m/%Y'))
+    return prepare_text(response)
 
-    bot.reply_to(message, prepare_text(response), parse_mode="Markdown")
 
-
-@bot.message_handler(commands=['lista_chetos', 'top_chetos'])
-def top_trainers(message):
-    log.debug("/lista_chetos " + str(message.chat.__dict__))
-    updated_time = list(models.Trainer.select().order_by(models.Trainer.last_checked.desc()).limit(1))[0].last_checked
-    top_trainers = models.Trainer.sorted_by_level()
-    top_cheaters = [trainer for trainer in top_trainers if trainer.name in CHEATERS
-                    if trainer.last_checked > datetime.now() + timedelta(days=-15)]
+def render_top_cheaters(state):
+    cheaters = [state.trainer(name.decode('utf-8')) for name in CHEATERS]
+    top_cheaters = sorted((trainer for trainer in cheaters if trainer is not None
+                           if trainer.last_checked > datetime.now() + timedelta(days=-15)),
+                          key=lambda trainer: (trainer.level, trainer.last_checked), reverse=True)
 
     response = ""
     response += "TOP 10 chetos de los últimos 15 días\n"
@@ -127,16 +190,13 @@ def top_trainers(message):
             response += "{:^5} {}{:16} \n".format(trainer.level, team_emoji, trainer.name)
     else:
         response += "No hay chetos registrados en los últimos días :)\n"
-    response += "Fecha: {}".format(updated_time.strftime('%H:%M %d/%m/%Y'))
+    response += "Fecha: {}".format(state.published.strftime('%H:%M %d/%m/%Y'))
+    return prepare_text(response)
 
-    bot.reply_to(message, prepare_text(response), parse_mode="Markdown")
 
-
-@bot.message_handler(commands=['top_gimnasios'])
-def gyms_per_trainer(message):
-    log.debug("/top_gimnasios " + str(message.chat.__dict__))
-    updated_time = list(models.Gym.select().order_by(models.Gym.last_checked.desc()).limit(1))[0].last_checked
-    top_gyms_owned = models.Trainer.top_gyms_owned()[:10]
+def render_gyms_per_trainer(state):
+    top_gyms_owned = sorted((trainer for trainer in state.trainers() if trainer.gyms_count),
+                            key=lambda trainer: trainer.gyms_count, reverse=True)[:10]
     response = ""
     response += "TOP 10 gimnasios por entrenador\n"
     response += "-" * 25 + "\n"
@@ -145,13 +205,107 @@ def gyms_per_trainer(message):
         cheater_flag = "*" if trainer.name in CHEATERS else ""
         team_emoji = TEAM_EMOJI[trainer.team_id].encode('utf-8')
         response += "{:2} {}{:15} {:2}\n".format(
-            len(trainer.gyms_membership), team_emoji, cheater_flag + trainer.name, trainer.level)
-    response += "Fecha: {}".format(updated_time.strftime('%H:%M %d/%m/%Y'))
+            trainer.gyms_count, team_emoji, cheater_flag + trainer.name, trainer.level)
+    response += "Fecha: {}".format(state.published.strftime('%H:%M %d/%m/%Y'))
+    return prepare_text(response)
+
+
+def find_trainer(state, query):
+    """Returns the trainer matching the query (exact, ignoring case or only candidate) or the suggested names."""
+    trainer = state.trainer(query)
+    if trainer is not None:
+        return trainer, []
+    trainer_index.refresh(state)
+    names = trainer_index.exact(query)
+    if len(names) != 1:
+        names = names or trainer_index.suggestions(query)
+    if len(names) == 1:
+        return state.trainer(names[0]), []
+    return None, names
+
+
+def render_trainer(state, query):
+    """Returns the answer text and its parse mode."""
+    trainer, suggestions = find_trainer(state, query)
+    if trainer is None:
+        if not suggestions:
+            return "No hay datos para ese entrenador", None
+        response = "No hay datos para ese entrenador. ¿Quizás buscas...?\n"
+        response += "\n".join("/entrenador {}".format(name.encode('utf-8')) for name in suggestions)
+        return response, None
+
+    team_emoji = TEAM_EMOJI[trainer.team_id].encode('utf-8')
+    response = "{} {} (level {})\n".format(trainer.name, team_emoji, trainer.level)
+    response += "-" * 25 + "\n"
+    gyms = state.trainer_members(trainer.name)
+
+    for member in gyms:
+        gym_name = member.gym.name.encode('utf-8')
+        response += "{:10} {:4}CP - {}\n".format(POKEMON[member.pokemon_id], member.cp, gym_name)
+
+    if not gyms:
+        response += "No controla ningún gimnasio"
+    return prepare_text(response), "Markdown"
+
+
+def render_team_control(days=7):
+    data = analytics.summary(days=days, top=5)
+    shares = data['team_control']['shares']
+    holds = data['hold_durations']
+    response = ""
+    response += "Control de gimnasios ({} días)\n".format(days)
+    response += "-" * 25 + "\n"
+    response += "{:10} {:>6} {:>8}\n".format("EQUIPO", "MEDIA", "RETIENE")
+    for team_id, team in enumerate(models.TEAMS):
+        team_shares = shares[team]
+        average = sum(team_shares) / len(team_shares) * 100 if team_shares else 0
+        mean_hold = holds[team]['mean_seconds']
+        hold_text = "{:.1f}h".format(mean_hold / 3600) if mean_hold is not None else "-"
+        response += "{}{:9} {:5.1f}% {:>8}\n".format(TEAM_EMOJI[team_id].encode('utf-8'), team, average, hold_text)
+    response += "\nGimnasios más disputados\n"
+    for gym in data['flip_rates']:
+        response += "{:4.1f}/día {}\n".format(gym['flips_per_day'], gym['name'].encode('utf-8'))
+    return prepare_text(response)
+
+
+def reply_cached(message, key, render):
+    """Replies with the cached answer for the current live state version, rendering it on the first request."""
+    state = get_live_state(message)
+    if state is None:
+        return
+    bot.reply_to(message, response_cache.get(key, state.version, lambda: render(state)), parse_mode="Markdown")
+
+
+@bot.message_handler(commands=['equipos'])
+@profiled('/equipos')
+def gyms_by_team(message):
+    log.debug("/equipos " + str(message.chat.__dict__))
+    reply_cached(message, '/equipos', render_gyms_by_team)
+
+
+@bot.message_handler(commands=['top_entrenadores'])
+@profiled('/top_entrenadores')
+def top_trainers(message):
+    log.debug("/top_entrenadores " + str(message.chat.__dict__))
+    reply_cached(message, '/top_entrenadores', render_top_trainers)
+
+
+@bot.message_handler(commands=['lista_chetos', 'top_chetos'])
+@profiled('/top_chetos')
+def top_cheaters(message):
+    log.debug("/lista_chetos " + str(message.chat.__dict__))
+    reply_cached(message, '/top_chetos', render_top_cheaters)
+
 
-    bot.reply_to(message, prepare_text(response), parse_mode="Markdown")
+@bot.message_handler(commands=['top_gimnasios'])
+@profiled('/top_gimnasios')
+def gyms_per_trainer(message):
+    log.debug("/top_gimnasios " + str(message.chat.__dict__))
+    reply_cached(message, '/top_gimnasios', render_gyms_per_trainer)
 
 
 @bot.message_handler(commands=['entrenador'])
+@profiled('/entrenador')
 def entrenador(message):
     log.debug(message.text + str(message.chat.__dict__))
     try:
@@ -159,26 +313,174 @@ def entrenador(message):
     except IndexError:
         bot.reply_to(message, "Indica el nombre del entrenador: /entrenador NOMBRE")
         return
-    try:
-        trainer = Trainer.get(Trainer.name == trainer_name)
-    except DoesNotExist:
-        bot.reply_to(message, "No hay datos para ese entrenador")
+    state = get_live_state(message)
+    if state is None:
         return
+    response, parse_mode = response_cache.get(('/entrenador', trainer_name), state.version,
+                                              lambda: render_trainer(state, trainer_name))
+    bot.reply_to(message, response, parse_mode=parse_mode)
+
+
+@bot.message_handler(commands=['control'])
+@profiled('/control')
+def team_control(message):
+    log.debug("/control " + str(message.chat.__dict__))
+    reply_cached(message, '/control', lambda state: render_team_control())
+
+
+def render_notification(state, summaries, gym_ids, trainer_events):
+    def gym_name(gym_id):
+        gym = state.gym(gym_id) if state is not None else None
+        return gym.name.encode('utf-8') if gym is not None else gym_id
+
+    response = "Novedades de lo que sigues\n"
+    for gym_id in gym_ids:
+        summary = summaries[gym_id]
+        response += "\n{}\n".format(gym_name(gym_id))
+        team_id = summary['team_id']
+        if team_id == models.Gym.UNCONTESTED:
+            response += "  Ha quedado libre\n"
+        elif team_id is not None:
+            response += "  Conquistado por {}{}\n".format(TEAM_EMOJI[team_id].encode('utf-8'), models.TEAMS[team_id])
+        elif summary['points']:
+            response += "  {:+d} puntos\n".format(summary['points'])
+        if summary['joined']:
+            response += "  Entran: {}\n".format(", ".join(sorted(summary['joined'])).encode('utf-8'))
+        if summary['left']:
+            response += "  Salen: {}\n".format(", ".join(sorted(summary['left'])).encode('utf-8'))
+    if trainer_events:
+        response += "\n"
+    for trainer, gym_id, joined in trainer_events:
+        response += "{} {} {}\n".format(trainer.encode('utf-8'), "entra en" if joined else "sale de", gym_name(gym_id))
+    return response[:MAX_MESSAGE_LENGTH].decode('utf-8', 'ignore')
+
+
+def send_notification(chat_id, summaries, gym_ids, trainer_events):
+    bot.send_message(chat_id, render_notification(live_state.get(), summaries, gym_ids, trainer_events))
+
+
+def command_argument(message):
+    parts = message.text.split(None, 1)
+    return parts[1].strip() if len(parts) > 1 else None
+
+
+def subscribe(message, kind, key, name, gyms=None):
+    if subscriptions.subscribe(message.chat.id, kind, key, name, gyms):
+        bot.reply_to(message, "Te avisaré de los cambios en {}".format(name.encode('utf-8')))
+    else:
+        bot.reply_to(message, "Ya lo sigues o sigues demasiadas cosas (máximo {}). "
+                              "Consulta /siguiendo".format(subscriptions.max_subscriptions))
 
-    team_emoji = TEAM_EMOJI[trainer.team_id].encode('utf-8')
-    response = "{} {} (level {})\n".format(trainer.name, team_emoji, trainer.level)
-    response += "-" * 25 + "\n"
-    gyms = trainer.gyms_membership
 
-    for gym in gyms:
-        pokemon = gym.pokemon
-        gym_name = gym.gym.name.encode('utf-8')
-        response += "{:10} {:4}CP - {}\n".format(POKEMON[pokemon.pokemon_id], pokemon.cp, gym_name)
+def find_gyms(state, query):
+    query = query.lower()
+    gyms = [gym for gym in state.gyms() if query in gym.name.lower()]
+    return [gym for gym in gyms if gym.name.lower() == query] or gyms
+
 
+@bot.message_handler(commands=['seguir_gimnasio'])
+def follow_gym(message):
+    log.debug(message.text + str(message.chat.__dict__))
+    query = command_argument(message)
+    if not query:
+        bot.reply_to(message, "Indica el nombre del gimnasio: /seguir_gimnasio NOMBRE")
+        return
+    state = get_live_state(message)
+    if state is None:
+        return
+    gyms = find_gyms(state, query)
     if not gyms:
-        response += "No controla ningún gimnasio"
+        bot.reply_to(message, "No hay ningún gimnasio con ese nombre")
+    elif len(gyms) > 1:
+        response = "Hay varios gimnasios con ese nombre:\n"
+        response += "\n".join(gym.name.encode('utf-8') for gym in gyms[:10])
+        bot.reply_to(message, response)
+    else:
+        subscribe(message, GYM, gyms[0].id, gyms[0].name)
+
 
-    bot.reply_to(message, prepare_text(response), parse_mode="Markdown")
+@bot.message_handler(commands=['seguir_entrenador'])
+def follow_trainer(message):
+    log.debug(message.text + str(message.chat.__dict__))
+    query = command_argument(message)
+    if not query:
+        bot.reply_to(message, "Indica el nombre del entrenador: /seguir_entrenador NOMBRE")
+        return
+    state = get_live_state(message)
+    if state is None:
+        return
+    trainer, suggestions = find_trainer(state, query)
+    if trainer is not None:
+        subscribe(message, TRAINER, trainer.name, trainer.name)
+    elif suggestions:
+        response = "No hay datos para ese entrenador. ¿Quizás buscas...?\n"
+        response += "\n".join("/seguir_entrenador {}".format(name.encode('utf-8')) for name in suggestions)
+        bot.reply_to(message, response)
+    else:
+        bot.reply_to(message, "No hay datos para ese entrenador")
+
+
+def follow_area(message, latitude, longitude, radius):
+    state = get_live_state(message)
+    if state is None:
+        return
+    gyms = gyms_in_area(state.gyms(), latitude, longitude, radius)
+    if not gyms:
+        bot.reply_to(message, "No hay gimnasios a menos de {}m de ese punto".format(radius))
+        return
+    name = u"la zona de {}m en {:.5f}, {:.5f} ({} gimnasios)".format(radius, latitude, longitude, len(gyms))
+    subscribe(message, AREA, [round(latitude, 5), round(longitude, 5), radius], name, gyms)
+
+
+@bot.message_handler(commands=['seguir_zona'])
+def follow_area_command(message):
+    log.debug(message.text + str(message.chat.__dict__))
+    try:
+        args = message.text.split()[1:]
+        latitude, longitude = float(args[0]), float(args[1])
+        radius = int(args[2]) if len(args) > 2 else AREA_RADIUS
+    except (IndexError, ValueError):
+        bot.reply_to(message, "Indica el centro y el radio de la zona: /seguir_zona LATITUD LONGITUD [METROS], "
+                              "o envíame una ubicación")
+        return
+    follow_area(message, latitude, longitude, radius)
+
+
+@bot.message_handler(content_types=['location'])
+def follow_location(message):
+    log.debug("Location " + str(message.chat.__dict__))
+    follow_area(message, message.location.latitude, message.location.longitude, AREA_RADIUS)
+
+
+@bot.message_handler(commands=['siguiendo'])
+def following(message):
+    log.debug("/siguiendo " + str(message.chat.__dict__))
+    followed = subscriptions.subscriptions(message.chat.id)
+    if not followed:
+        bot.reply_to(message, "No sigues nada. Usa /seguir_gimnasio, /seguir_entrenador o /seguir_zona")
+        return
+    response = "Sigues:\n"
+    response += "\n".join("{}. {}".format(idx + 1, subscription['name'].encode('utf-8'))
+                          for idx, subscription in enumerate(followed))
+    response += "\n\nPara dejar de seguir algo: /dejar_de_seguir NÚMERO (o sin número para todo)"
+    bot.reply_to(message, response)
+
+
+@bot.message_handler(commands=['dejar_de_seguir'])
+def unfollow(message):
+    log.debug(message.text + str(message.chat.__dict__))
+    argument = command_argument(message)
+    try:
+        idx = int(argument) - 1 if argument else None
+    except ValueError:
+        bot.reply_to(message, "Indica el número que aparece en /siguiendo: /dejar_de_seguir NÚMERO")
+        return
+    removed = subscriptions.unsubscribe(message.chat.id, idx)
+    if removed:
+        bot.reply_to(message, "Ya no sigues {}".format(
+            ", ".join(subscription['name'] for subscription in removed).encode('utf-8')))
+    else:
+        bot.reply_to(message, "No hay nada que dejar de seguir. Consulta /siguiendo")
 
 
 @bot.message_handler(commands=['about'])
@@ -194,9 +496,18 @@ def other_message(message):
     log.debug("Incorrect command: " + message.text + " " + str(message.chat.__dict__))
 
 if __name__ == "__main__":
+    models.init_database(read_only=True)
     load_cheaters(CHEATERS_FILE)
     print CHEATERS
+    if BOT_API_URL:
+        use_api_url(BOT_API_URL)
+    Notifier(subscriptions, send_notification).start()
     try:
-        bot.polling(none_stop=True)
+        if BOT_WEBHOOK_PORT:
+            if BOT_WEBHOOK_URL:
+                bot.set_webhook(BOT_WEBHOOK_URL)
+            webhook_server(bot, BOT_WEBHOOK_PORT, BOT_WEBHOOK_PATH).serve_forever()
+        else:
+            bot.polling(none_stop=True)
     except Exception as ex:
         log.error(ex)
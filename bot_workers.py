@@ -0,0 +1,161 @@
+# coding: utf-8
+"""Concurrent execution of the bot handlers and webhook intake of the Telegram updates."""
+import Queue
+import logging
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import deque
+
+import telebot
+from telebot import apihelper
+
+from config import BOT_WORKERS, BOT_CHAT_QUEUE_SIZE, BOT_CHAT_RATE, BOT_CHAT_BURST
+from ratelimit import TokenBucket
+
+log = logging.getLogger(__name__)
+
+# Forget the rate limit of the chats idle for this long (seconds)
+IDLE_CHAT_TIMEOUT = 10 * 60
+
+
+class ChatWorkerPool(object):
+    """Runs tasks in worker threads, in order for each chat and concurrently across chats.
+
+    Each chat has its own queue of at most chat_queue_size tasks and is served one task at a
+    time, taking turns with the other chats, so a slow command only delays its own chat. Tasks
+    from chats over their rate limit (rate per second, up to burst at once) or with a full queue
+    are dropped.
+    """
+
+    def __init__(self, workers=BOT_WORKERS, chat_queue_size=BOT_CHAT_QUEUE_SIZE, rate=BOT_CHAT_RATE,
+                 burst=BOT_CHAT_BURST):
+        self.chat_queue_size = chat_queue_size
+        self.rate = rate
+        self.burst = burst
+        self.chat_queues = {}  # chat_id -> deque of (task, args, kwargs), while the chat has work
+        self.ready = Queue.Queue()  # chats waiting for a worker, each one at most once
+        self.buckets = {}  # chat_id -> TokenBucket
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.threads = []
+        for idx in range(workers):
+            thread = threading.Thread(target=self._work, name='bot-worker-{}'.format(idx))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            now = time.time()
+            if len(self.buckets) > 10000:
+                self.buckets = dict((key, value) for key, value in self.buckets.iteritems()
+                                    if now - value.updated < IDLE_CHAT_TIMEOUT)
+            bucket = self.buckets[chat_id] = TokenBucket(self.rate, capacity=self.burst)
+        return bucket
+
+    def submit(self, chat_id, task, *args, **kwargs):
+        """Queues the task for the chat. Returns False if it was dropped."""
+        with self.lock:
+            chat_queue = self.chat_queues.get(chat_id)
+            if not self._bucket(chat_id).try_acquire() or (chat_queue is not None and
+                                                           len(chat_queue) >= self.chat_queue_size):
+                self.dropped += 1
+                log.info("Dropped message from chat {} (rate limit or queue full)".format(chat_id))
+                return False
+            if chat_queue is None:
+                chat_queue = self.chat_queues[chat_id] = deque()
+                self.ready.put(chat_id)
+            chat_queue.append((task, args, kwargs))
+        return True
+
+    def _work(self):
+        while True:
+            chat_id = self.ready.get()
+            with self.lock:
+                task, args, kwargs = self.chat_queues[chat_id].popleft()
+            try:
+                task(*args, **kwargs)
+            except Exception:
+                log.exception("Error handling a message from chat {}".format(chat_id))
+            with self.lock:
+                if self.chat_queues[chat_id]:
+                    self.ready.put(chat_id)
+                else:
+                    del self.chat_queues[chat_id]
+
+
+def message_chat_id(update):
+    chat = getattr(update, 'chat', None)
+    if chat is not None:
+        return chat.id
+    from_user = getattr(update, 'from_user', None)
+    return from_user.id if from_user is not None else None
+
+
+class PooledTeleBot(telebot.TeleBot):
+    """TeleBot running its handlers in a ChatWorkerPool instead of one by one."""
+
+    def __init__(self, token, pool=None, **kwargs):
+        kwargs['threaded'] = False
+        telebot.TeleBot.__init__(self, token, **kwargs)
+        self.pool = pool or ChatWorkerPool()
+
+    def _exec_task(self, task, *args, **kwargs):
+        update = args[0] if args else None
+        if isinstance(update, list):  # Update listeners get all the new messages
+            self.pool.submit(None, task, *args, **kwargs)
+        else:
+            self.pool.submit(message_chat_id(update), task, *args, **kwargs)
+
+
+def use_api_url(api_url):
+    """Sends the Telegram API requests to another base url ({0} token, {1} method), e.g. a fake endpoint."""
+    make_request = apihelper._make_request
+
+    def make_request_to(token, method_name, method='get', params=None, files=None, base_url=None):
+        return make_request(token, method_name, method, params, files, base_url=api_url)
+
+    apihelper._make_request = make_request_to
+    log.info("Using Telegram API at {}".format(api_url))
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != self.server.webhook_path:
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        try:
+            update = telebot.types.Update.de_json(body.decode('utf-8'))
+        except (ValueError, KeyError) as ex:
+            log.warn("Invalid update: {}".format(ex))
+            self.send_error(400)
+            return
+        # Only queues the handlers, so Telegram gets its answer right away
+        self.server.bot.process_new_updates([update])
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def webhook_server(bot, port, path, host='127.0.0.1'):
+    """HTTP server passing the updates POSTed to path to the bot. Call serve_forever() to run it."""
+    server = HTTPServer((host, port), WebhookHandler)
+    server.bot = bot
+    server.webhook_path = path
+    log.info("Receiving updates on http://{}:{}{}".format(host, port, path))
+    return server
+
+
+def start_webhook(bot, port, path, host='127.0.0.1'):
+    """Serves the webhook intake in a background thread. Returns the server."""
+    server = webhook_server(bot, port, path, host)
+    thread = threading.Thread(target=server.serve_forever, name='webhook')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,107 @@
+# coding: utf-8
+import heapq
+import logging
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+from pgoapi.utilities import get_cell_ids
+from s2sphere import CellId, LatLng
+
+from config import CELL_SWEEP_INTERVAL
+
+log = logging.getLogger(__name__)
+
+# Level of the S2 cells returned by get_map_objects
+CELL_LEVEL = 15
+
+MapRequest = namedtuple('MapRequest', ['latitude', 'longitude', 'cell_ids'])
+
+
+def gym_cell_id(latitude, longitude, level=CELL_LEVEL):
+    return CellId.from_lat_lng(LatLng.from_degrees(latitude, longitude)).parent(level).id()
+
+
+def plan_map_requests(gyms):
+    """Covers the cells with gyms with as few get_map_objects requests as possible.
+
+    Greedy: each request is made from the center of a cell not covered yet and asks for every cell
+    with gyms around it.
+    """
+    gym_cells = OrderedDict()
+    for gym_id, latitude, longitude in gyms:
+        gym_cells.setdefault(gym_cell_id(latitude, longitude), []).append(gym_id)
+
+    requests = []
+    covered = set()
+    for s2_cell_id in gym_cells:
+        if s2_cell_id in covered:
+            continue
+        center = CellId(s2_cell_id).to_lat_lng()
+        latitude, longitude = center.lat().degrees, center.lng().degrees
+        cell_ids = [c for c in get_cell_ids(latitude, longitude) if c in gym_cells and c not in covered]
+        if s2_cell_id not in cell_ids:
+            cell_ids.append(s2_cell_id)
+        covered.update(cell_ids)
+        requests.append(MapRequest(latitude, longitude, tuple(cell_ids)))
+    log.info("{} map requests cover {} cells with gyms".format(len(requests), len(gym_cells)))
+    return requests
+
+
+def is_gym(fort):
+    return fort.get('type', 0) == 0  # FortType.GYM
+
+
+class CellScheduler(object):
+    """Sweeps the gym cells with get_map_objects and only asks for the details of the gyms whose
+    last_modified_timestamp_ms moved since the last scan.
+
+    Has the same interface as scheduler.ScanScheduler, with map requests and gyms as tasks.
+    """
+
+    def __init__(self, gyms, state, sweep_interval=CELL_SWEEP_INTERVAL):
+        self.state = state
+        self.sweep_interval = sweep_interval
+        self.gyms = set(gym[0] for gym in gyms)
+        self.pending = OrderedDict()  # Gyms whose details must be requested
+        self.heap = [(time.time(), request) for request in plan_map_requests(gyms)]
+        heapq.heapify(self.heap)
+
+        for gym in gyms:  # Unknown gyms are requested right away
+            if gym[0] not in state.gyms:
+                self.pending[gym[0]] = gym
+
+    def __len__(self):
+        return len(self.gyms)
+
+    def seconds_until_due(self):
+        if self.pending:
+            return 0
+        if not self.heap:
+            return self.sweep_interval
+        return max(self.heap[0][0] - time.time(), 0)
+
+    def pop_due(self, limit):
+        tasks = []
+        while self.pending and len(tasks) < limit:
+            tasks.append(self.pending.popitem(last=False)[1])
+        now = time.time()
+        while self.heap and len(tasks) < limit and self.heap[0][0] <= now:
+            tasks.append(heapq.heappop(self.heap)[1])
+        return tasks
+
+    def reschedule(self, task, changed=False):
+        if isinstance(task, MapRequest):
+            heapq.heappush(self.heap, (time.time() + self.sweep_interval, task))
+        else:
+            self.gyms.add(task[0])
+
+    def on_map_objects(self, forts):
+        """Queues the details request of the gyms modified since the last scan."""
+        for fort in forts:
+            if not is_gym(fort) or fort['id'] in self.pending:
+                continue
+            last_modified = datetime.utcfromtimestamp(fort['last_modified_timestamp_ms'] / 1000.0)
+            if self.state.is_modified(fort['id'], last_modified):
+                self.gyms.add(fort['id'])
+                self.pending[fort['id']] = (fort['id'], fort['latitude'], fort['longitude'])
@@ -0,0 +1,91 @@
+# coding: utf-8
+import logging
+from collections import defaultdict
+
+from models import Gym, GymMember, check_gym_changes
+
+log = logging.getLogger(__name__)
+
+GYM_STATE_FIELDS = (Gym.id, Gym.name, Gym.team_id, Gym.gym_points, Gym.is_in_battle, Gym.last_modified)
+
+
+class CityState(object):
+    """In-memory copy of the current gyms and their members, used to diff scanned data without reading the DB.
+
+    gyms maps gym id to a dict with the fields needed by check_gym_changes and members maps gym id
+    to a set of (trainer name, pokemon id) pairs.
+    """
+
+    def __init__(self):
+        self.gyms = {}
+        self.members = defaultdict(set)
+
+    @classmethod
+    def load(cls):
+        state = cls()
+        for gym in Gym.select(*GYM_STATE_FIELDS).dicts():
+            state.gyms[gym['id']] = gym
+        query = GymMember.select(GymMember.gym, GymMember.trainer, GymMember.pokemon).tuples()
+        for gym_id, trainer_name, pokemon_id in query:
+            state.members[gym_id].add((trainer_name, pokemon_id))
+        log.info("Loaded state of {} gyms".format(len(state.gyms)))
+        return state
+
+    def is_modified(self, gym_id, last_modified):
+        gym = self.gyms.get(gym_id)
+        return gym is None or gym['last_modified'] != last_modified
+
+    def trainers(self, gym_id):
+        return set(trainer_name for trainer_name, _ in self.members.get(gym_id, ()))
+
+    def diff(self, gyms, gym_members):
+        """Returns the GymLog rows for the changes between the known state and the new gyms."""
+        actions = []
+        for gym_id, new_gym in gyms.iteritems():
+            gym = self.gyms.get(gym_id)
+            if gym is None:
+                log.debug("Adding new gym: {}".format(new_gym['name'].encode('utf-8')))
+                continue
+            if gym['last_modified'] != new_gym['last_modified']:
+                actions.extend(check_gym_changes(gym, self.trainers(gym_id), new_gym, gym_members[gym_id]))
+        return actions
+
+    def member_changes(self, gyms, gym_members):
+        """Returns the GymMember rows to insert and, per gym, the pokemon ids that left it."""
+        new_gym_members = []
+        lost_gym_members = {}
+        for gym_id in gyms:
+            old_members = self.members.get(gym_id, set())
+            new_members = set()
+            for member in gym_members[gym_id]:
+                key = (member['trainer'], member['pokemon'])
+                new_members.add(key)
+                if key not in old_members:
+                    new_gym_members.append(member)
+            lost = [pokemon_id for _, pokemon_id in old_members - new_members]
+            if lost:
+                lost_gym_members[gym_id] = lost
+        return new_gym_members, lost_gym_members
+
+    def stats_changes(self, gyms, gym_members):
+        """Returns the change in the number of gyms of each team and of each trainer."""
+        team_deltas = defaultdict(int)
+        trainer_deltas = defaultdict(int)
+        for gym_id, new_gym in gyms.iteritems():
+            gym = self.gyms.get(gym_id)
+            if gym is None or gym['team_id'] != new_gym['team_id']:
+                team_deltas[new_gym['team_id']] += 1
+                if gym is not None:
+                    team_deltas[gym['team_id']] -= 1
+            old_trainers = self.trainers(gym_id)
+            new_trainers = set(member['trainer'] for member in gym_members[gym_id])
+            for trainer_name in new_trainers - old_trainers:
+                trainer_deltas[trainer_name] += 1
+            for trainer_name in old_trainers - new_trainers:
+                trainer_deltas[trainer_name] -= 1
+        return team_deltas, trainer_deltas
+
+    def update(self, gyms, gym_members):
+        for gym_id, new_gym in gyms.iteritems():
+            self.gyms[gym_id] = dict((field.name, new_gym[field.name]) for field in GYM_STATE_FIELDS)
+            self.members[gym_id] = set((member['trainer'], member['pokemon']) for member in gym_members[gym_id])
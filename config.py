@@ -2,10 +2,120 @@ SERVICE_PROVIDER = "AUTH_PROVIDER"
 USERNAME = "YOUR_EMAIL"
 PASSWORD = "YOUR_PASSWORD"
 
+# Accounts used by the scanner. Each account keeps its own session and scans concurrently
+ACCOUNTS = [
+    (SERVICE_PROVIDER, USERNAME, PASSWORD),
+]
+
 DATABASE = "database.sqlite"
+# Seconds to wait for a lock on the database before failing
+DATABASE_BUSY_TIMEOUT = 10
+
+# Append-only archive of the raw gym responses
+ARCHIVE_DIR = "archive"
+ARCHIVE_SEGMENT_SIZE = 64 * 1024 * 1024
 
 BOT_API_TOKEN = 'YOU_BOT_API_TOKEN'
+# Rendered bot answers kept per live state generation (per-trainer answers are evicted LRU)
+BOT_CACHE_SIZE = 256
+# Bot handler threads. Messages of a chat are handled in order, up to BOT_CHAT_QUEUE_SIZE waiting
+BOT_WORKERS = 8
+BOT_CHAT_QUEUE_SIZE = 5
+# Messages/s (and burst) accepted from each chat. Messages over the limit are dropped
+BOT_CHAT_RATE = 0.5
+BOT_CHAT_BURST = 5
+# Port of the local webhook intake (updates pushed by Telegram through a reverse proxy at
+# BOT_WEBHOOK_URL). None uses long polling
+BOT_WEBHOOK_PORT = None
+BOT_WEBHOOK_PATH = "/webhook"
+BOT_WEBHOOK_URL = None
+# Telegram API base url ({0} token, {1} method). Set it to the fake endpoint of fake_telegram.py to test the bot
+BOT_API_URL = None
 
+# SQL profiling of bot commands and web requests (see profiler.py)
+PROFILE_QUERIES = False
+# Seconds
+SLOW_QUERY_THRESHOLD = 0.1
+# Times the same query must run in a command/request to be flagged as a possible N+1
+N_PLUS_ONE_THRESHOLD = 5
 
-# Delay between gym scans
+
+# Initial delay between gym scans (per account). The request rate then adapts to the throttling seen
 GYM_SCAN_DELAY = 1
+# Limits (requests/s per account) and AIMD steps of the adaptive request rate
+MIN_REQUEST_RATE = 0.1
+MAX_REQUEST_RATE = 5
+RATE_INCREASE = 0.01
+RATE_DECREASE = 0.5
+# Max speed (m/s) of each account moving between gyms. 0 disables the limit
+MAX_TRAVEL_SPEED = 50
+
+
+# Scan scheduling (seconds). Busy gyms are scanned every MIN_GYM_SCAN_INTERVAL at most,
+# quiet gyms every MAX_GYM_STALENESS at least
+MIN_GYM_SCAN_INTERVAL = 30
+MAX_GYM_STALENESS = 15 * 60
+# 'details' requests the details of every gym by priority. 'cells' sweeps the gym cells with
+# get_map_objects and only requests the details of the gyms modified since the last scan
+SCAN_MODE = 'details'
+# Minimum seconds between two sweeps of the same cells
+CELL_SWEEP_INTERVAL = 60
+# GymLog activity used to prioritize gyms
+GYM_ACTIVITY_WINDOW = 6 * 60 * 60
+GYM_ACTIVITY_REFRESH = 10 * 60
+
+# Port of the scanner metrics listener (http://localhost:PORT/metrics). None disables it
+METRICS_PORT = 8001
+
+# Failed gyms are retried with exponential backoff (seconds) and given up after MAX_RETRIES attempts
+# failing on their own (login, throttling and network errors are retried without counting). Given
+# up gyms are probed again every DEAD_GYM_PROBE_INTERVAL seconds
+RETRY_QUEUE_FILE = "retry_queue.json"
+RETRY_BASE_DELAY = 10
+RETRY_MAX_DELAY = 30 * 60
+MAX_RETRIES = 8
+DEAD_GYM_PROBE_INTERVAL = 6 * 60 * 60
+
+# Local simulated game server (see simulator.py). Set SIMULATED_GYMS to a number of gyms to scan
+# a simulated city instead of the real service
+SIMULATED_GYMS = 0
+SIMULATED_CHANGES_PER_SECOND = 1.0
+# Fraction of requests failing as throttled and of logins failing
+SIMULATED_THROTTLE_RATE = 0.0
+SIMULATED_AUTH_FAILURE_RATE = 0.0
+
+# GymLog rollups (see rollups.py). The scanner builds the hourly and daily rollups and prunes old
+# rows every ROLLUP_INTERVAL seconds (None disables it). Raw GymLog rows are kept GYM_LOG_RETENTION
+# days and hourly rollups HOURLY_ROLLUP_RETENTION days. Daily rollups are kept forever
+ROLLUP_INTERVAL = 60 * 60
+GYM_LOG_RETENTION = 30
+HOURLY_ROLLUP_RETENTION = 180
+# Longest gap (seconds) between two in battle scans of a gym still counted as time in battle
+MAX_BATTLE_GAP = 10 * 60
+# Rows deleted per transaction when pruning
+PRUNE_BATCH_SIZE = 5000
+
+# Pre-serialized gyms published by the scanner for the web map (see snapshot.py), at most every
+# SNAPSHOT_INTERVAL seconds. The last SNAPSHOT_DELTAS versions are kept to answer /gyms?after=
+GYMS_SNAPSHOT_FILE = "gyms_snapshot.json"
+SNAPSHOT_INTERVAL = 5
+SNAPSHOT_DELTAS = 120
+
+# Seconds between checkpoints of the full gym state, used to rebuild the city at any time
+# (see history.py). Checkpoints older than GYM_LOG_RETENTION are thinned to one per day
+CHECKPOINT_INTERVAL = 60 * 60
+
+# Binary live state (gyms, members and trainers) published by the scanner for the bot and the web
+# (see livestate.py), at most every LIVE_STATE_INTERVAL seconds
+LIVE_STATE_FILE = "live_state.bin"
+LIVE_STATE_INTERVAL = 5
+
+# Gyms, trainers and areas followed by the bot chats (see notifications.py). New events are sent
+# every NOTIFY_INTERVAL seconds, one message per chat, at most NOTIFY_RATE messages/s
+SUBSCRIPTIONS_FILE = "subscriptions.json"
+MAX_SUBSCRIPTIONS = 20
+NOTIFY_INTERVAL = 60
+NOTIFY_RATE = 25
+NOTIFY_BATCH_SIZE = 5000
+# Default radius (meters) of the areas followed with /seguir_zona or by sending a location
+AREA_RADIUS = 500
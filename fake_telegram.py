@@ -0,0 +1,210 @@
+# coding: utf-8
+"""Local fake of the Telegram Bot API, to test the bot without Telegram.
+
+Serves getMe, getUpdates, setWebhook, deleteWebhook and sendMessage, records the messages sent
+by the bot and delivers the injected updates through getUpdates or, in webhook mode, by
+POSTing them to the bot. Run it as a script to load test the bot:
+
+    python fake_telegram.py --chats 50 --messages 10 --command /top_gimnasios --webhook
+"""
+import Queue
+import argparse
+import json
+import logging
+import threading
+import time
+import urllib2
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import defaultdict
+
+from utils import setup_logging
+
+log = logging.getLogger(__name__)
+
+BOT_USER = {'id': 1, 'first_name': 'PokemonGoSDC', 'username': 'pokemongosdc_bot'}
+
+
+class FakeTelegram(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, host='127.0.0.1'):
+        HTTPServer.__init__(self, (host, port), FakeTelegramHandler)
+        self.updates = Queue.Queue()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.webhook_url = None
+        self.sent = []  # (time, chat_id, reply_to_message_id, text)
+        self.lock = threading.Lock()
+
+    @property
+    def api_url(self):
+        """Base url for use_api_url()."""
+        return 'http://{}:{}/bot{{0}}/{{1}}'.format(*self.server_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='fake-telegram')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def send_update(self, chat_id, text):
+        """Injects a message from a user. Returns its message_id."""
+        with self.lock:
+            update_id = self.next_update_id
+            message_id = self.next_message_id
+            self.next_update_id += 1
+            self.next_message_id += 1
+        update = {
+            'update_id': update_id,
+            'message': {
+                'message_id': message_id,
+                'from': {'id': chat_id, 'first_name': 'Trainer {}'.format(chat_id)},
+                'chat': {'id': chat_id, 'type': 'private'},
+                'date': int(time.time()),
+                'text': text,
+            }
+        }
+        if self.webhook_url:
+            request = urllib2.Request(self.webhook_url, json.dumps(update), {'Content-Type': 'application/json'})
+            urllib2.urlopen(request).read()
+        else:
+            self.updates.put(update)
+        return message_id
+
+    def get_updates(self, offset, timeout):
+        """Long polls the queued updates. Updates are removed once fetched, so offset is not needed."""
+        updates = []
+        try:
+            updates.append(self.updates.get(timeout=timeout) if timeout > 0 else self.updates.get_nowait())
+            while True:
+                updates.append(self.updates.get_nowait())
+        except Queue.Empty:
+            pass
+        return [update for update in updates if update['update_id'] >= offset]
+
+    def sent_message(self, params):
+        chat_id = int(params['chat_id'])
+        reply_to = params.get('reply_to_message_id')
+        with self.lock:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            self.sent.append((time.time(), chat_id, int(reply_to) if reply_to else None, params.get('text', '')))
+        return {
+            'message_id': message_id,
+            'from': BOT_USER,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'date': int(time.time()),
+            'text': params.get('text', ''),
+        }
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    def _params(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.getheader('content-length', 0))
+        if length:
+            body = self.rfile.read(length)
+            if self.headers.getheader('content-type', '').startswith('application/json'):
+                params.update(json.loads(body))
+            else:
+                params.update(urlparse.parse_qsl(body))
+        return url.path.rsplit('/', 1)[-1], params
+
+    def _handle(self):
+        method, params = self._params()
+        server = self.server
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'getUpdates':
+            result = server.get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)))
+        elif method == 'sendMessage':
+            result = server.sent_message(params)
+        elif method == 'setWebhook':
+            server.webhook_url = params.get('url') or None
+            result = True
+        elif method == 'deleteWebhook':
+            server.webhook_url = None
+            result = True
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps({'ok': True, 'result': result})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _handle
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def report(fake, sent_ids, started, dropped):
+    """Logs the latency of the answers and checks that each chat got them in order."""
+    answers = defaultdict(list)
+    for sent_time, chat_id, reply_to, _ in fake.sent:
+        answers[chat_id].append(reply_to)
+    latencies = sorted(sent_time - started[reply_to] for sent_time, _, reply_to, _ in fake.sent
+                       if reply_to in started)
+    out_of_order = [chat_id for chat_id, replies in answers.items() if replies != sorted(replies)]
+    log.info("{} messages sent, {} answered, {} dropped by the bot".format(
+        sum(len(ids) for ids in sent_ids.values()), len(fake.sent), dropped))
+    if latencies:
+        log.info("Latency: p50 {:.3f}s, p95 {:.3f}s, max {:.3f}s".format(
+            latencies[len(latencies) / 2], latencies[int(len(latencies) * 0.95)], latencies[-1]))
+    if out_of_order:
+        log.error("Answers out of order in chats {}".format(out_of_order))
+    else:
+        log.info("Answers in order in every chat")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot against a fake Telegram API")
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=5, help="Messages per chat")
+    parser.add_argument('--command', default='/equipos')
+    parser.add_argument('--webhook', action='store_true', help="Push the updates to the webhook intake")
+    parser.add_argument('--webhook-port', type=int, default=8443)
+    parser.add_argument('--wait', type=float, default=10, help="Seconds to wait for the answers")
+    args = parser.parse_args()
+    setup_logging()
+
+    import bot
+    import models
+    from bot_workers import use_api_url, start_webhook
+    from config import BOT_WEBHOOK_PATH
+
+    fake = FakeTelegram().start()
+    use_api_url(fake.api_url)
+    models.init_database(read_only=True)
+    bot.load_cheaters(bot.CHEATERS_FILE)
+    if args.webhook:
+        start_webhook(bot.bot, args.webhook_port, BOT_WEBHOOK_PATH)
+        fake.webhook_url = 'http://127.0.0.1:{}{}'.format(args.webhook_port, BOT_WEBHOOK_PATH)
+    else:
+        thread = threading.Thread(target=bot.bot.polling, kwargs={'none_stop': True, 'timeout': 1})
+        thread.daemon = True
+        thread.start()
+
+    started = {}
+    sent_ids = defaultdict(list)
+    for _ in range(args.messages):
+        for chat_id in range(1, args.chats + 1):
+            message_id = fake.send_update(chat_id, args.command)
+            started[message_id] = time.time()
+            sent_ids[chat_id].append(message_id)
+
+    expected = sum(len(ids) for ids in sent_ids.values())
+    deadline = time.time() + args.wait
+    while time.time() < deadline and len(fake.sent) + bot.bot.pool.dropped < expected:
+        time.sleep(0.1)
+    report(fake, sent_ids, started, bot.bot.pool.dropped)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,25 +2,30 @@
 import csv
 import json
 import logging
-from collections import Counter
 from datetime import datetime
-from time import sleep
-
-from peewee import InsertQuery
-from pgoapi.exceptions import ServerSideRequestThrottlingException, AuthException
+from time import time
 
+import metrics
 import models
-from config import GYM_SCAN_DELAY, SERVICE_PROVIDER, USERNAME, PASSWORD
-from models import create_tables, Gym
-from utils import setup_logging, setup_api
+import rollups
+from archive import ResponseArchive
+from cells import CellScheduler, MapRequest
+from config import ACCOUNTS, SIMULATED_GYMS, SCAN_MODE, METRICS_PORT, ROLLUP_INTERVAL, \
+    CHECKPOINT_INTERVAL
+from city_state import CityState
+from history import Checkpointer
+from livestate import LiveStatePublisher
+from models import create_tables
+from ratelimit import RetryQueue
+from route import RoutePlanner
+from scheduler import ScanScheduler
+from sessions import SessionPool
+from snapshot import GymSnapshot
+from utils import setup_logging, timed
 
 log = logging.getLogger(__name__)
 
 
-class LoginFailedException(Exception):
-    pass
-
-
 def read_gyms_from_csv(csv_file):
     gyms = []
 
@@ -40,50 +45,12 @@ def read_gyms_from_csv(csv_file):
     return gyms
 
 
-def save_to_json(data):
-    with open('gym_details.json', 'w') as output_file:
-        json.dump(data, output_file, indent=2)
-
-
 def read_data_from_json(path):
     with open(path) as data_file:
         return json.load(data_file)
 
 
-def get_data_from_server(gyms_coords):
-    setup_logging()
-    position = (42.878529, -8.544476, 0)  # Catedral
-    try:
-        api = setup_api(position, SERVICE_PROVIDER, USERNAME, PASSWORD)
-    except Exception as e:
-        log.error("Error setting up api: " + str(e))
-        raise LoginFailedException("Error setting up api")
-
-    if api is None:
-        raise LoginFailedException("Error setting up api")
-    gym_details = []
-
-    for gym_id, gym_lat, gym_lng in gyms_coords:
-        api.set_position(gym_lat, gym_lng, 0)
-        try:
-            response_dict = api.get_gym_details(gym_id=gym_id)
-        except Exception as e:
-            log.error("Error getting data from server: " + str(e))
-            continue
-        if response_dict is None or 'responses' not in response_dict or 'GET_GYM_DETAILS' not in response_dict[
-            "responses"]:
-            log.warn("No GET_GYM_DETAILS in response. Skipping cell...")
-            continue
-        gym_detail = response_dict["responses"]["GET_GYM_DETAILS"]
-        gym_details.append(gym_detail)
-
-        sleep(GYM_SCAN_DELAY)
-    log.info("New info for {} gyms".format(len(gym_details)))
-    return gym_details
-
-
-def parse_and_insert_to_database(gym_details):
-    create_tables()
+def parse_gym_details(gym_details, state):
     now = datetime.now()
 
     gyms = {}
@@ -99,12 +66,10 @@ def parse_and_insert_to_database(gym_details):
         gym_id = gym_data['id']
         last_modified = datetime.utcfromtimestamp(gym_data['last_modified_timestamp_ms'] / 1000.0)  # todo Warning UTC
 
-        # Check if gymm modified
-        gym = Gym.get(Gym.id == gym_id)
-        if gym.last_modified == last_modified:
+        # Check if gym modified
+        if not state.is_modified(gym_id, last_modified):
             continue
 
-
         team_id = gym_data.get('owned_by_team', models.Gym.UNCONTESTED)
         gyms[gym_id] = {
             'id': gym_id,
@@ -155,24 +120,43 @@ def parse_and_insert_to_database(gym_details):
 
         gym_members[gym_id] = members
 
-    models.update_gyms(gyms, gym_members)
+    return gyms, gym_members, trainers, pokemons
 
-    if trainers:
-        InsertQuery(models.Trainer, rows=trainers.values()).upsert().execute()
-    log.info("Upserted {} trainers".format(len(trainers)))
-    if pokemons:
-        InsertQuery(models.Pokemon, rows=pokemons.values()).upsert().execute()
-    log.info("Upserted {} pokemons".format(len(pokemons)))
+
+def parse_and_insert_to_database(gym_details, state, timings=None, publishers=()):
+    """Parses, diffs and writes a batch of GET_GYM_DETAILS responses. Returns the ids of the modified gyms.
+
+    If a timings dict is given, the seconds spent on each stage are added to it. The modified gyms
+    are also passed to the publishers (GymSnapshot, LiveStatePublisher), if any.
+    """
+    with timed(timings, 'parse'):
+        gyms, gym_members, trainers, pokemons = parse_gym_details(gym_details, state)
+    with timed(timings, 'diff'):
+        actions = state.diff(gyms, gym_members)
+        new_gym_members, lost_gym_members = state.member_changes(gyms, gym_members)
+        team_deltas, trainer_deltas = state.stats_changes(gyms, gym_members)
+    with timed(timings, 'write'):
+        models.update_gyms(gyms, trainers, pokemons, new_gym_members, lost_gym_members, actions,
+                           team_deltas, trainer_deltas)
+    state.update(gyms, gym_members)
+    for publisher in publishers:
+        publisher.update(gyms, gym_members, trainers, pokemons)
+
+    metrics.GYMS_SCANNED.inc(amount=len(gym_details))
+    metrics.GYMS_MODIFIED.inc(amount=len(gyms))
+    for action in actions:
+        metrics.EVENTS.inc(action['action'])
+
+    return set(gyms)
 
 
 def gyms_by_team():
-    gyms = models.Gym.select()
-    team_counter = Counter([gym.team for gym in gyms])
+    team_counter = dict((team.team, team.gyms) for team in models.TeamStats.select())
     total_gyms = sum(team_counter.values())
     response = ""
     response += "Gimnasios por equipos\n"
     response += "-" * 30 + "\n"
-    response += "Número de gimnasios: {}\n".format(models.Gym.select().count())
+    response += "Número de gimnasios: {}\n".format(total_gyms)
     teams = team_counter.items()
     teams = sorted(teams, key=lambda x: x[1], reverse=True)
     for team, gyms_owned in teams:
@@ -199,7 +183,7 @@ def top_gyms_owned():
     response += "{:>2}  {:12} {:2} {:<5} \n".format("#", "TRAINER", "LEVEL", "TEAM")
     for trainer in top_gyms_owned:
         response += "{:2}  {:15} {:2} {:7} \n".format(
-            len(trainer.gyms_membership), trainer.name, trainer.level, trainer.team)
+            trainer.gyms_count, trainer.name, trainer.level, trainer.team)
     return response
 
 
@@ -216,30 +200,121 @@ def gyms_details():
     return response
 
 
-def main():
-    gyms = read_gyms_from_csv('gyms_santiago.csv')
-    while True:
-        try:
-            # gym_details = read_data_from_json('gym_details.json')
-
-            gym_details = []
-            for gym in gyms:
-                try:
-                    gym_details = get_data_from_server([gym])
-                    parse_and_insert_to_database(gym_details)
-                except AuthException, e:
-                    log.error(str(e))
-                    sleep(5)
-
-            save_to_json(gym_details)
+def scan_loop(pool, scheduler, state, archive=None, retry_queue=None, duration=None, timings=None, publishers=(),
+              checkpointer=None):
+    """Scans the gyms picked by the scheduler with the session pool and writes the results.
+
+    The scheduler is a ScanScheduler or, to sweep cells first, a CellScheduler. Raw responses are
+    appended to the archive, if given. Failed gyms go to the retry queue, if given, and are
+    retried before any other gym once their backoff expires. The publishers get the modified
+    gyms and publish them every few seconds, and the checkpointer, if given, saves the city
+    state periodically.
+
+    Runs forever unless a duration (seconds) is given. Returns the number of gym details received.
+    """
+    end_time = time() + duration if duration is not None else None
+    scanned = 0
+    scanned_since_report = 0
+    in_flight = 0
+    while end_time is None or time() < end_time:
+        for publisher in publishers:
+            publisher.publish_if_due()
+        if checkpointer is not None:
+            checkpointer.take_if_due(state)
+        tasks = retry_queue.pop_due(pool.size - in_flight) if retry_queue is not None else []
+        tasks += scheduler.pop_due(pool.size - in_flight - len(tasks))
+        for task in tasks:
+            pool.submit(task)
+            in_flight += 1
+
+        timeout = 1
+        if in_flight == 0:
+            timeout = min(scheduler.seconds_until_due(), timeout)
+            if retry_queue is not None:
+                timeout = min(retry_queue.seconds_until_due(timeout), timeout)
+        result = pool.get_result(timeout=timeout)
+        if result is None:
+            continue
+
+        # Write every result already available as a single batch
+        results = [result]
+        while result is not None:
+            result = pool.get_result(timeout=0)
+            if result is not None:
+                results.append(result)
+        in_flight -= len(results)
+
+        gym_results = []
+        for task, result, error in results:
+            if isinstance(task, MapRequest):
+                if result is not None:
+                    scheduler.on_map_objects(result)
+                scheduler.reschedule(task)
+                continue
+
+            if archive is not None and result is not None:
+                archive.append(task[0], result)
+            if result is None or 'gym_state' not in result:
+                if retry_queue is not None:
+                    # No result means a login, throttling or network error, not a problem of the gym
+                    retry_queue.failed(task, error or "No gym state in response", transient=result is None)
+                else:
+                    scheduler.reschedule(task)
+            else:
+                gym_results.append((task, result))
+                if retry_queue is not None:
+                    retry_queue.succeeded(task[0])
+        if archive is not None:
+            archive.flush()
+        if retry_queue is not None:
+            retry_queue.save()
+            metrics.RETRY_QUEUE_SIZE.set(len(retry_queue))
+
+        batch = [gym_detail for _, gym_detail in gym_results]
+        scanned += len(batch)
+        scanned_since_report += len(batch)
+        modified_gyms = parse_and_insert_to_database(batch, state, timings, publishers) if batch else set()
+        for gym, _ in gym_results:
+            scheduler.reschedule(gym, changed=gym[0] in modified_gyms)
+
+        if scanned_since_report >= len(scheduler):
+            log.info("New info for {} gyms".format(scanned_since_report))
+            scanned_since_report = 0
 
             # print gyms_details()
             print gyms_by_team()
             # print top_trainers()
             print top_gyms_owned()
-        except (LoginFailedException, ServerSideRequestThrottlingException) as e:
-            log.error("Login failed: " + str(e))
-        log.debug("Sleeping...")
+    return scanned
+
+
+def main():
+    setup_logging()
+    create_tables()
+    if METRICS_PORT:
+        metrics.start_server(METRICS_PORT)
+    if ROLLUP_INTERVAL:
+        rollups.start_maintenance(ROLLUP_INTERVAL)
+    if SIMULATED_GYMS:
+        from simulator import get_world
+        gyms = get_world().gym_coords()
+    else:
+        gyms = read_gyms_from_csv('gyms_santiago.csv')
+    retry_queue = RetryQueue()
+    # Gyms left in the retry queue are only scanned by it, dead ones as probes. The scheduler
+    # takes them again once a scan succeeds
+    gyms = [gym for gym in gyms if gym[0] not in retry_queue.dead and gym[0] not in retry_queue]
+    state = CityState.load()
+    if SCAN_MODE == 'cells':
+        scheduler = CellScheduler(gyms, state)
+    else:
+        scheduler = ScanScheduler(gyms, route=RoutePlanner(gyms), accounts=len(ACCOUNTS))
+    pool = SessionPool(ACCOUNTS)
+    pool.start()
+    checkpointer = Checkpointer() if CHECKPOINT_INTERVAL else None
+    publishers = [GymSnapshot.load(), LiveStatePublisher.load()]
+    scan_loop(pool, scheduler, state, ResponseArchive(), retry_queue, publishers=publishers,
+              checkpointer=checkpointer)
 
 
 if __name__ == '__main__':
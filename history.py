@@ -0,0 +1,143 @@
+# coding: utf-8
+"""Point-in-time state of the city.
+
+The scanner saves a checkpoint of every gym (team, points, battle flag and member trainers) every
+CHECKPOINT_INTERVAL seconds. state_at() loads the nearest checkpoint before the requested time
+and replays the GymLog events after it, so rebuilding any moment only reads one checkpoint and
+at most CHECKPOINT_INTERVAL seconds of log.
+
+Gyms discovered after a checkpoint only appear from the next one. Replaying needs the raw
+GymLog, so times older than GYM_LOG_RETENTION are rounded down to the checkpoint kept for that day.
+"""
+import json
+import logging
+import time
+import zlib
+from datetime import datetime
+
+from config import CHECKPOINT_INTERVAL
+from models import GymCheckpoint, GymLog, TEAMS, init_database
+
+log = logging.getLogger(__name__)
+
+
+class GymState(object):
+    __slots__ = ('team_id', 'gym_points', 'is_in_battle', 'trainers')
+
+    def __init__(self, team_id, gym_points, is_in_battle, trainers):
+        self.team_id = team_id
+        self.gym_points = gym_points
+        self.is_in_battle = is_in_battle
+        self.trainers = set(trainers)
+
+    def serialize(self):
+        return {
+            "team_id": self.team_id,
+            "gym_points": self.gym_points,
+            "is_in_battle": self.is_in_battle,
+            "members_count": len(self.trainers),
+        }
+
+
+def encode_checkpoint(gyms):
+    data = dict((gym_id, [gym.team_id, gym.gym_points, gym.is_in_battle, sorted(gym.trainers)])
+                for gym_id, gym in gyms.iteritems())
+    return zlib.compress(json.dumps(data, separators=(',', ':')))
+
+
+def decode_checkpoint(blob):
+    return dict((gym_id, GymState(*values)) for gym_id, values in json.loads(zlib.decompress(blob)).iteritems())
+
+
+def take_checkpoint(state, timestamp=None):
+    """Saves the gyms of a CityState as a checkpoint."""
+    gyms = dict((gym_id, GymState(gym['team_id'], gym['gym_points'], gym['is_in_battle'], state.trainers(gym_id)))
+                for gym_id, gym in state.gyms.iteritems())
+    return GymCheckpoint.create(timestamp=timestamp or datetime.now(), gyms=encode_checkpoint(gyms))
+
+
+def apply_event(gyms, gym_id, action, trainer_name, gym_points, team_id):
+    gym = gyms.get(gym_id)
+    if gym is None:
+        return
+    if action == GymLog.IN_BATTLE:
+        gym.is_in_battle = True
+    elif action == GymLog.STOP_BATTLE:
+        gym.is_in_battle = False
+    elif action in (GymLog.GYM_TRAINED, GymLog.GYM_ATTACKED):
+        gym.gym_points = gym_points
+    elif action == GymLog.GYM_CONQUESTED:
+        gym.team_id = team_id
+        gym.gym_points = gym_points
+    elif action == GymLog.NEW_GYM_MEMBER:
+        gym.trainers.add(trainer_name)
+    elif action == GymLog.LOST_GYM_MEMBER:
+        gym.trainers.discard(trainer_name)
+
+
+def state_at(timestamp):
+    """Returns the state of every gym at a datetime as {gym_id: GymState}, or None if it is older than
+    the first checkpoint."""
+    checkpoint = (GymCheckpoint.select()
+                  .where(GymCheckpoint.timestamp <= timestamp)
+                  .order_by(GymCheckpoint.timestamp.desc())
+                  .first())
+    if checkpoint is None:
+        return None
+    gyms = decode_checkpoint(checkpoint.gyms)
+    events = (GymLog.select(GymLog.gym, GymLog.action, GymLog.trainer, GymLog.gym_points, GymLog.team_id)
+              .where((GymLog.timestamp > checkpoint.timestamp) & (GymLog.timestamp <= timestamp))
+              .order_by(GymLog.timestamp, GymLog.id)
+              .tuples())
+    for event in events:
+        apply_event(gyms, *event)
+    return gyms
+
+
+def prune_checkpoints(before):
+    """Keeps only the first checkpoint of each day before `before`. Returns the checkpoints deleted."""
+    sql = ('DELETE FROM "gymcheckpoint" WHERE "timestamp" < ? AND "id" NOT IN '
+           '(SELECT MIN("id") FROM "gymcheckpoint" GROUP BY date("timestamp"))')
+    return init_database().execute_sql(sql, (GymCheckpoint.timestamp.db_value(before),)).rowcount
+
+
+class Checkpointer(object):
+    """Takes a checkpoint of the scanner's CityState every `interval` seconds."""
+
+    def __init__(self, interval=CHECKPOINT_INTERVAL):
+        self.interval = interval
+        last = GymCheckpoint.select(GymCheckpoint.timestamp).order_by(GymCheckpoint.timestamp.desc()).first()
+        self.last = time.mktime(last.timestamp.timetuple()) if last is not None else 0
+
+    def take_if_due(self, state):
+        if time.time() - self.last < self.interval:
+            return None
+        checkpoint = take_checkpoint(state)
+        self.last = time.time()
+        log.info("Saved checkpoint of {} gyms".format(len(state.gyms)))
+        return checkpoint
+
+
+def main():
+    import argparse
+    from models import Gym
+
+    parser = argparse.ArgumentParser(description="Print the gyms by team at a point in time")
+    parser.add_argument('timestamp', help="YYYY-mm-dd HH:MM")
+    args = parser.parse_args()
+
+    timestamp = datetime.strptime(args.timestamp, '%Y-%m-%d %H:%M')
+    start = time.time()
+    gyms = state_at(timestamp)
+    if gyms is None:
+        print "No checkpoint before {}".format(timestamp)
+        return
+    print "State of {} gyms rebuilt in {:.1f}ms".format(len(gyms), (time.time() - start) * 1000)
+    names = dict(Gym.select(Gym.id, Gym.name).tuples())
+    for gym_id, gym in sorted(gyms.iteritems(), key=lambda item: item[1].team_id):
+        print "{:8} {:6} {:2} {}".format(TEAMS[gym.team_id], gym.gym_points, len(gym.trainers),
+                                         names.get(gym_id, gym_id).encode('utf-8'))
+
+
+if __name__ == '__main__':
+    main()
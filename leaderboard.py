@@ -0,0 +1,38 @@
+# coding: utf-8
+"""Trainer leaderboard kept ordered as the scanner upserts trainers."""
+import bisect
+from collections import defaultdict
+
+MAX_TRAINER_LEVEL = 50
+
+
+class Leaderboard(object):
+    """Trainers ordered by level and, within a level, by last check (most recent first).
+
+    Updating a trainer only moves it inside its level buckets. The publisher writes the buckets
+    to the live state, and LiveState.top_trainers() reads the top from there.
+    """
+
+    def __init__(self):
+        self.levels = defaultdict(list)  # level -> sorted [(-last_checked, name)]
+        self.keys = {}  # name -> (level, (-last_checked, name))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def update(self, name, level, last_checked):
+        """last_checked is a unix timestamp."""
+        key = (min(level, MAX_TRAINER_LEVEL), (-last_checked, name))
+        old_key = self.keys.get(name)
+        if old_key == key:
+            return
+        if old_key is not None:
+            bucket = self.levels[old_key[0]]
+            del bucket[bisect.bisect_left(bucket, old_key[1])]
+        bisect.insort(self.levels[key[0]], key[1])
+        self.keys[name] = key
+
+    def iter_levels(self):
+        """Yields (level, [names]) from the lowest level, names by most recent check."""
+        for level in range(MAX_TRAINER_LEVEL + 1):
+            yield level, [name for _, name in self.levels.get(level, ())]
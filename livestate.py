@@ -0,0 +1,331 @@
+# coding: utf-8
+"""Binary snapshot of the live state (gyms, members and trainers) shared by the scanner, the bot and the web.
+
+The scanner keeps the live state in memory and publishes it to LIVE_STATE_FILE every few seconds.
+Each publication writes a new file, with the next generation number, and renames it over the
+previous one. Readers mmap the file read-only, so all processes share the same pages, and read
+the records in place with struct. They reopen the file when it is replaced, and swap to the new
+mapping with a single assignment: a request uses either the old generation or the new one, never
+a mix of both.
+
+Layout (little endian): header, gym records sorted by id, trainer records sorted by name, member
+records grouped by gym, the member indexes of each trainer, the leaderboard (start of each level,
+then the trainer indexes by level and most recent check) and the string table (offsets, then the
+utf-8 data). Names and ids are interned in the string table and referenced by index.
+"""
+import bisect
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from config import LIVE_STATE_FILE, LIVE_STATE_INTERVAL
+from leaderboard import Leaderboard, MAX_TRAINER_LEVEL
+from models import Gym, GymMember, Pokemon, Trainer, TEAMS, gym_level
+
+log = logging.getLogger(__name__)
+
+LIVE_STATE_PATH = os.path.join(os.path.dirname(__file__), LIVE_STATE_FILE)
+
+MAGIC = 'PGLS'
+FORMAT_VERSION = 2
+# magic, format version, generation, published at, gyms, trainers, members, strings, gyms per team
+HEADER = struct.Struct('<4sIQdIIII' + 'I' * len(TEAMS))
+# id, name, team_id, is_in_battle, level, gym_points, latitude, longitude, last_modified, last_checked,
+# first member, members count
+GYM_RECORD = struct.Struct('<IIBBBxiddddII')
+# name, level, team_id, gyms, last_checked, first trainer member, memberships count
+TRAINER_RECORD = struct.Struct('<IBBHdII')
+# gym, trainer, pokemon_id, cp
+MEMBER_RECORD = struct.Struct('<IIHH')
+INDEX = struct.Struct('<I')
+
+LiveGym = namedtuple('LiveGym', ['id', 'name', 'team_id', 'is_in_battle', 'level', 'gym_points', 'latitude',
+                                 'longitude', 'last_modified', 'last_checked', 'members_count'])
+LiveTrainer = namedtuple('LiveTrainer', ['name', 'level', 'team_id', 'gyms_count', 'last_checked'])
+LiveMember = namedtuple('LiveMember', ['gym', 'trainer', 'pokemon_id', 'cp'])
+
+
+def to_timestamp(value):
+    return time.mktime(value.timetuple()) if value is not None else 0
+
+
+class LiveStatePublisher(object):
+    """Scanner side: the live state in memory, written to the file when it changes."""
+
+    def __init__(self, path=LIVE_STATE_PATH, interval=LIVE_STATE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.gyms = {}  # gym_id -> dict of Gym fields
+        self.members = {}  # gym_id -> [(trainer name, pokemon_id, cp)]
+        self.trainers = {}  # trainer name -> (level, team_id, last_checked)
+        self.leaderboard = Leaderboard()
+        self.generation = 0
+        self.dirty = False
+        self.published = 0
+
+    @classmethod
+    def load(cls, **kwargs):
+        publisher = cls(**kwargs)
+        for gym in Gym.select().dicts():
+            publisher.gyms[gym['id']] = gym
+            publisher.members[gym['id']] = []
+        query = GymMember.select(GymMember.gym, GymMember.trainer, Pokemon.pokemon_id, Pokemon.cp).join(Pokemon)
+        for gym_id, trainer_name, pokemon_id, cp in query.tuples():
+            publisher.members[gym_id].append((trainer_name, pokemon_id, cp))
+        for name, level, team_id, last_checked in Trainer.select(Trainer.name, Trainer.level, Trainer.team_id,
+                                                                 Trainer.last_checked).tuples():
+            publisher.trainers[name] = (level, team_id, last_checked)
+            publisher.leaderboard.update(name, level, to_timestamp(last_checked))
+        publisher.generation = LiveState.current_generation(publisher.path)
+        publisher.publish()
+        return publisher
+
+    def update(self, gyms, gym_members, trainers, pokemons):
+        """Takes the modified gyms of a batch (as returned by parse_gym_details)."""
+        for gym_id, gym in gyms.iteritems():
+            self.gyms[gym_id] = gym
+            self.members[gym_id] = [(member['trainer'], pokemons[member['pokemon']]['pokemon_id'],
+                                     pokemons[member['pokemon']]['cp']) for member in gym_members[gym_id]]
+        for name, trainer in trainers.iteritems():
+            self.trainers[name] = (trainer['level'], trainer['team_id'], trainer['last_checked'])
+            self.leaderboard.update(name, trainer['level'], to_timestamp(trainer['last_checked']))
+        self.dirty = self.dirty or bool(gyms)
+
+    def publish_if_due(self):
+        if self.dirty and time.time() - self.published >= self.interval:
+            self.publish()
+
+    def publish(self):
+        self.generation += 1
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(self.serialize())
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+        self.published = time.time()
+        log.debug("Published live state generation {}".format(self.generation))
+
+    def serialize(self):
+        strings = []
+        string_index = {}
+
+        def intern(value):
+            idx = string_index.get(value)
+            if idx is None:
+                idx = string_index[value] = len(strings)
+                strings.append(value)
+            return idx
+
+        gym_ids = sorted(self.gyms)
+        trainer_names = sorted(self.trainers)
+        gym_numbers = dict((gym_id, idx) for idx, gym_id in enumerate(gym_ids))
+        trainer_numbers = dict((name, idx) for idx, name in enumerate(trainer_names))
+
+        gym_records = []
+        member_records = []
+        trainer_members = dict((name, []) for name in trainer_names)
+        trainer_gyms = dict((name, set()) for name in trainer_names)
+        team_counts = [0] * len(TEAMS)
+        for gym_id in gym_ids:
+            gym = self.gyms[gym_id]
+            members = [member for member in self.members.get(gym_id, ()) if member[0] in trainer_numbers]
+            gym_records.append(GYM_RECORD.pack(
+                intern(gym_id), intern(gym['name']), gym['team_id'], gym['is_in_battle'],
+                gym_level(gym['gym_points']), gym['gym_points'], gym['latitude'], gym['longitude'],
+                to_timestamp(gym['last_modified']), to_timestamp(gym['last_checked']),
+                len(member_records), len(members)))
+            team_counts[gym['team_id']] += 1
+            for trainer_name, pokemon_id, cp in members:
+                trainer_members[trainer_name].append(len(member_records))
+                trainer_gyms[trainer_name].add(gym_id)
+                member_records.append(MEMBER_RECORD.pack(gym_numbers[gym_id], trainer_numbers[trainer_name],
+                                                         pokemon_id, min(cp, 0xffff)))
+
+        trainer_records = []
+        trainer_member_indexes = []
+        for name in trainer_names:
+            level, team_id, last_checked = self.trainers[name]
+            trainer_records.append(TRAINER_RECORD.pack(
+                intern(name), level, team_id, len(trainer_gyms[name]), to_timestamp(last_checked),
+                len(trainer_member_indexes), len(trainer_members[name])))
+            trainer_member_indexes.extend(INDEX.pack(idx) for idx in trainer_members[name])
+
+        level_starts = []
+        leaderboard = []
+        for level, names in self.leaderboard.iter_levels():
+            level_starts.append(INDEX.pack(len(leaderboard)))
+            leaderboard.extend(INDEX.pack(trainer_numbers[name]) for name in names)
+        level_starts.append(INDEX.pack(len(leaderboard)))
+
+        encoded = [value.encode('utf-8') for value in strings]
+        string_offsets = []
+        offset = 0
+        for value in encoded:
+            string_offsets.append(INDEX.pack(offset))
+            offset += len(value)
+        string_offsets.append(INDEX.pack(offset))
+
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, self.generation, time.time(), len(gym_records),
+                             len(trainer_records), len(member_records), len(strings), *team_counts)
+        return ''.join([header] + gym_records + trainer_records + member_records + trainer_member_indexes +
+                       level_starts + leaderboard + string_offsets + encoded)
+
+
+class RecordSequence(object):
+    """Sequence view of the keys of a sorted record section, for bisect."""
+
+    def __init__(self, get_key, count):
+        self.get_key = get_key
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        return self.get_key(idx)
+
+
+class LiveState(object):
+    """One generation of the live state, read in place from the mapped file."""
+
+    def __init__(self, path=LIVE_STATE_PATH):
+        with open(path, 'rb') as fp:
+            self.stat = os.fstat(fp.fileno())
+            self.buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self.buffer, 0)
+        magic, version, self.generation, published = header[:4]
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("{} is not a live state file (version {})".format(path, FORMAT_VERSION))
+        self.published = datetime.fromtimestamp(published)
+        # Increases with every publication, even if the scanner restarts the generations
+        self.version = (published, self.generation)
+        self.gyms_count, self.trainers_count, self.members_count, self.strings_count = header[4:8]
+        self.team_counts = list(header[8:])
+        self.gyms_offset = HEADER.size
+        self.trainers_offset = self.gyms_offset + self.gyms_count * GYM_RECORD.size
+        self.members_offset = self.trainers_offset + self.trainers_count * TRAINER_RECORD.size
+        self.trainer_members_offset = self.members_offset + self.members_count * MEMBER_RECORD.size
+        self.levels_offset = self.trainer_members_offset + self.members_count * INDEX.size
+        self.leaderboard_offset = self.levels_offset + (MAX_TRAINER_LEVEL + 2) * INDEX.size
+        self.string_offsets_offset = self.leaderboard_offset + self.trainers_count * INDEX.size
+        self.strings_offset = self.string_offsets_offset + (self.strings_count + 1) * INDEX.size
+
+    @staticmethod
+    def current_generation(path=LIVE_STATE_PATH):
+        try:
+            return LiveState(path).generation
+        except (IOError, OSError, ValueError, struct.error):
+            return 0
+
+    def string(self, idx):
+        start, end = struct.unpack_from('<II', self.buffer, self.string_offsets_offset + idx * INDEX.size)
+        return self.buffer[self.strings_offset + start:self.strings_offset + end].decode('utf-8')
+
+    def _gym_record(self, idx):
+        return GYM_RECORD.unpack_from(self.buffer, self.gyms_offset + idx * GYM_RECORD.size)
+
+    def _trainer_record(self, idx):
+        return TRAINER_RECORD.unpack_from(self.buffer, self.trainers_offset + idx * TRAINER_RECORD.size)
+
+    def gym_at(self, idx):
+        (id_idx, name_idx, team_id, is_in_battle, level, gym_points, latitude, longitude, last_modified,
+         last_checked, _, members_count) = self._gym_record(idx)
+        return LiveGym(self.string(id_idx), self.string(name_idx), team_id, bool(is_in_battle), level, gym_points,
+                       latitude, longitude, datetime.fromtimestamp(last_modified),
+                       datetime.fromtimestamp(last_checked), members_count)
+
+    def trainer_name_at(self, idx):
+        return self.string(self._trainer_record(idx)[0])
+
+    def trainer_at(self, idx):
+        name_idx, level, team_id, gyms_count, last_checked, _, _ = self._trainer_record(idx)
+        return LiveTrainer(self.string(name_idx), level, team_id, gyms_count, datetime.fromtimestamp(last_checked))
+
+    def member_at(self, idx):
+        gym_idx, trainer_idx, pokemon_id, cp = MEMBER_RECORD.unpack_from(
+            self.buffer, self.members_offset + idx * MEMBER_RECORD.size)
+        return LiveMember(self.gym_at(gym_idx), self.trainer_at(trainer_idx), pokemon_id, cp)
+
+    def _find(self, get_key, count, key):
+        keys = RecordSequence(get_key, count)
+        idx = bisect.bisect_left(keys, key)
+        return idx if idx < count and keys[idx] == key else None
+
+    def gyms(self):
+        return [self.gym_at(idx) for idx in xrange(self.gyms_count)]
+
+    def gym(self, gym_id):
+        idx = self._find(lambda i: self.string(self._gym_record(i)[0]), self.gyms_count, gym_id)
+        return self.gym_at(idx) if idx is not None else None
+
+    def gym_members(self, gym_id):
+        idx = self._find(lambda i: self.string(self._gym_record(i)[0]), self.gyms_count, gym_id)
+        if idx is None:
+            return []
+        record = self._gym_record(idx)
+        return [self.member_at(member_idx) for member_idx in xrange(record[10], record[10] + record[11])]
+
+    def trainers(self):
+        return [self.trainer_at(idx) for idx in xrange(self.trainers_count)]
+
+    def trainer(self, name):
+        idx = self._find(lambda i: self.string(self._trainer_record(i)[0]), self.trainers_count, name)
+        return self.trainer_at(idx) if idx is not None else None
+
+    def top_trainers(self, k, exclude=(), since=None):
+        """The k trainers with the highest level (most recently checked first) not in `exclude` and
+        checked after `since` (datetime), read from the leaderboard without visiting the rest."""
+        since = to_timestamp(since) if since is not None else None
+        level_starts = struct.unpack_from('<{}I'.format(MAX_TRAINER_LEVEL + 2), self.buffer, self.levels_offset)
+        result = []
+        for level in range(MAX_TRAINER_LEVEL, -1, -1):
+            for position in xrange(level_starts[level], level_starts[level + 1]):
+                trainer_idx, = INDEX.unpack_from(self.buffer, self.leaderboard_offset + position * INDEX.size)
+                record = self._trainer_record(trainer_idx)
+                if since is not None and record[4] < since:
+                    break
+                if self.string(record[0]) in exclude:
+                    continue
+                result.append(self.trainer_at(trainer_idx))
+                if len(result) >= k:
+                    return result
+        return result
+
+    def trainer_members(self, name):
+        """The pokemon the trainer has in gyms, as LiveMember."""
+        idx = self._find(lambda i: self.string(self._trainer_record(i)[0]), self.trainers_count, name)
+        if idx is None:
+            return []
+        _, _, _, _, _, first, count = self._trainer_record(idx)
+        indexes = struct.unpack_from('<{}I'.format(count), self.buffer,
+                                     self.trainer_members_offset + first * INDEX.size)
+        return [self.member_at(member_idx) for member_idx in indexes]
+
+
+class LiveStateReader(object):
+    """Gives the latest generation of the live state, remapping the file when the scanner replaces it."""
+
+    def __init__(self, path=LIVE_STATE_PATH):
+        self.path = path
+        self.state = None
+
+    def get(self):
+        """Returns the current LiveState, or None if the scanner has not published it yet."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return self.state
+        state = self.state
+        if state is None or (stat.st_ino, stat.st_mtime) != (state.stat.st_ino, state.stat.st_mtime):
+            try:
+                state = LiveState(self.path)
+            except (IOError, OSError, ValueError, struct.error) as ex:
+                log.warn("Can not load live state: {}".format(ex))
+                return self.state
+            # The previous mapping is closed when the requests still using it finish
+            self.state = state
+        return state
@@ -0,0 +1,190 @@
+# coding: utf-8
+"""In-process counters and latency histograms of the scan pipeline.
+
+Metrics are cheap to update (a lock and a few additions) and are always on. start_server()
+exposes them over HTTP: /metrics in Prometheus text format and / as a short human summary.
+"""
+import bisect
+import logging
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import defaultdict
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+START_TIME = time.time()
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, description, label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _labels(self, label_value, extra=''):
+        labels = []
+        if self.label is not None:
+            labels.append('{}="{}"'.format(self.label, label_value))
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.kind)]
+        lines.extend(self._render_values())
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, description, label=None):
+        super(Counter, self).__init__(name, description, label)
+        self.values = defaultdict(float)
+
+    def inc(self, label_value=None, amount=1):
+        with self.lock:
+            self.values[label_value] += amount
+
+    def value(self, label_value=None):
+        return self.values.get(label_value, 0)
+
+    def _render_values(self):
+        return ['{}{} {}'.format(self.name, self._labels(label_value), value)
+                for label_value, value in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, label_value=None):
+        with self.lock:
+            self.values[label_value] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, label=None, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, description, label)
+        self.buckets = buckets
+        self.counts = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self.sums = defaultdict(float)
+
+    def observe(self, value, label_value=None):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[label_value][idx] += 1
+            self.sums[label_value] += value
+
+    def count(self, label_value=None):
+        return sum(self.counts[label_value]) if label_value in self.counts else 0
+
+    def quantile(self, q, label_value=None):
+        """Estimates a quantile from the buckets (upper bound of the bucket where it falls)."""
+        counts = self.counts.get(label_value)
+        if not counts:
+            return None
+        target = q * sum(counts)
+        cumulative = 0
+        for idx, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= target:
+                return self.buckets[idx] if idx < len(self.buckets) else float('inf')
+
+    def _render_values(self):
+        lines = []
+        for label_value in sorted(self.counts):
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), self.counts[label_value]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, self._labels(label_value, 'le="{}"'.format(bucket)),
+                                                     cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self._labels(label_value), self.sums[label_value]))
+            lines.append('{}_count{} {}'.format(self.name, self._labels(label_value), cumulative))
+        return lines
+
+
+class time_histogram(object):
+    """Context manager observing the seconds spent in the block."""
+
+    def __init__(self, histogram, label_value=None):
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start, self.label_value)
+
+
+STAGE_LATENCY = Histogram('scanner_stage_seconds', "Time spent in each stage of the scan pipeline", 'stage')
+REQUESTS = Counter('scanner_requests_total', "Requests to the game servers by result", 'result')
+GYMS_SCANNED = Counter('scanner_gyms_scanned_total', "Gym details received")
+GYMS_MODIFIED = Counter('scanner_gyms_modified_total', "Gyms modified since their last scan")
+EVENTS = Counter('scanner_events_total', "GymLog rows written by action", 'action')
+REQUEST_RATE = Gauge('scanner_request_rate', "Current request rate (requests/s) of each account", 'account')
+RETRY_QUEUE_SIZE = Gauge('scanner_retry_queue_size', "Gyms waiting to be retried")
+
+
+def render_prometheus():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def render_summary():
+    uptime = time.time() - START_TIME
+    lines = [
+        "Uptime: {:.0f}s".format(uptime),
+        "Gyms scanned: {:.0f} ({:.2f} gyms/s), modified: {:.0f}".format(
+            GYMS_SCANNED.value(), GYMS_SCANNED.value() / uptime, GYMS_MODIFIED.value()),
+        "Requests: " + ", ".join("{} {:.0f}".format(result, count) for result, count in sorted(REQUESTS.values.items())),
+        "Events: " + ", ".join("{} {:.0f}".format(action, count) for action, count in sorted(EVENTS.values.items())),
+        "",
+        "{:8} {:>8} {:>8} {:>8} {:>8}".format("STAGE", "COUNT", "P50", "P95", "P99"),
+    ]
+    for stage in sorted(STAGE_LATENCY.counts):
+        lines.append("{:8} {:8} {:>8} {:>8} {:>8}".format(
+            stage, STAGE_LATENCY.count(stage),
+            *["{:.3f}s".format(STAGE_LATENCY.quantile(q, stage)) for q in (0.5, 0.95, 0.99)]))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = render_prometheus()
+        elif self.path == '/':
+            body = render_summary()
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def start_server(port, host='127.0.0.1'):
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    log.info("Serving metrics on http://{}:{}/metrics".format(host, port))
+    return server
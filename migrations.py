@@ -0,0 +1,114 @@
+# coding: utf-8
+"""Versioned schema migrations.
+
+The schema version is stored in SQLite's user_version pragma. migrate() applies, in order and each
+one in its own transaction, the migrations newer than that version. models.create_tables() runs
+it after creating the tables, so migrations must also work on a freshly created database.
+"""
+import logging
+
+log = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+def add_index(database, table, columns, unique=False):
+    name = '{}_{}'.format(table, '_'.join(columns))
+    database.execute_sql('CREATE {}INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(
+        'UNIQUE ' if unique else '', name, table, ', '.join('"{}"'.format(column) for column in columns)))
+
+
+def get_version(database):
+    return database.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def set_version(database, version):
+    database.execute_sql('PRAGMA user_version = {:d}'.format(version))
+
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def migrate(database):
+    version = get_version(database)
+    for migration_version, description, func in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        log.info("Migrating database to version {}: {}".format(migration_version, description))
+        with database.atomic():
+            func(database)
+            set_version(database, migration_version)
+        version = migration_version
+    return version
+
+
+@migration(1, "Index gyms by last update and last check (/gyms?after=, bot dates)")
+def index_gym_updates(database):
+    add_index(database, 'gym', ['last_updated'])
+    add_index(database, 'gym', ['last_checked'])
+
+
+@migration(2, "Index trainers by level and last check (leaderboards)")
+def index_trainer_leaderboards(database):
+    add_index(database, 'trainer', ['level', 'last_checked'])
+    add_index(database, 'trainer', ['last_checked'])
+
+
+@migration(3, "Index gym log by gym and time, and by time (gym history, scan scheduler activity)")
+def index_gym_log(database):
+    add_index(database, 'gymlog', ['gym_id', 'timestamp'])
+    add_index(database, 'gymlog', ['timestamp'])
+
+
+@migration(4, "Index gym members by gym and pokemon (membership updates)")
+def index_gym_members(database):
+    add_index(database, 'gymmember', ['gym_id', 'pokemon_id'])
+
+
+@migration(5, "Add gyms per team and gyms per trainer aggregate tables")
+def add_stats_tables(database):
+    from models import TeamStats, TrainerStats
+
+    database.create_tables([TeamStats, TrainerStats], safe=True)
+    database.execute_sql('DELETE FROM "teamstats"')
+    database.execute_sql('INSERT INTO "teamstats" ("team_id", "gyms") '
+                         'SELECT "team_id", COUNT(*) FROM "gym" GROUP BY "team_id"')
+    database.execute_sql('DELETE FROM "trainerstats"')
+    database.execute_sql('INSERT INTO "trainerstats" ("trainer_id", "gyms") '
+                         'SELECT "trainer_id", COUNT(DISTINCT "gym_id") FROM "gymmember" GROUP BY "trainer_id"')
+
+
+@migration(6, "Add hourly and daily GymLog rollups (gym history)")
+def add_gym_log_rollups(database):
+    from models import GymStatsHourly, GymStatsDaily, RollupProgress
+
+    database.create_tables([GymStatsHourly, GymStatsDaily, RollupProgress], safe=True)
+    add_index(database, 'gymstatshourly', ['gym_id', 'period_start'])
+    add_index(database, 'gymstatsdaily', ['gym_id', 'period_start'])
+
+
+@migration(7, "Add gym state checkpoints (point-in-time city state)")
+def add_gym_checkpoints(database):
+    from models import GymCheckpoint
+
+    database.create_tables([GymCheckpoint], safe=True)
+
+
+if __name__ == '__main__':
+    from models import create_tables, init_database
+
+    logging.basicConfig(level=logging.INFO)
+    create_tables()
+    database = init_database()
+    database.connect()
+    print "Database schema version: {} (latest: {})".format(get_version(database), latest_version())
+    database.close()
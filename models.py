@@ -4,33 +4,88 @@ import os
 from datetime import datetime, timedelta
 
 from peewee import Model, SqliteDatabase, CharField, IntegerField, BooleanField, DoubleField, DateTimeField, \
-    ForeignKeyField, fn, DeleteQuery, InsertQuery, DoesNotExist
+    ForeignKeyField, DeleteQuery, InsertQuery, CompositeKey, BlobField
 
-from config import DATABASE
+from config import DATABASE, DATABASE_BUSY_TIMEOUT
 
 TEAMS = ['Neutral', 'Mystic', 'Valor', 'Instinct']
+# Default SQLITE_MAX_VARIABLE_NUMBER
+SQLITE_MAX_VARIABLES = 999
 log = logging.getLogger(__name__)
 
 db = None
 
 
-def init_database():
+class SharedSqliteDatabase(SqliteDatabase):
+    """SQLite database shared by the scanner (the only writer), the bot and the web server.
+
+    Uses WAL journaling so readers never wait for the scanner's commits, one connection per thread
+    and a busy timeout instead of failing with "database is locked". Read-only databases refuse
+    any write on their connections.
+    """
+
+    def __init__(self, database, read_only=False, busy_timeout=DATABASE_BUSY_TIMEOUT, **kwargs):
+        self.read_only = read_only
+        self.busy_timeout = busy_timeout
+        kwargs.setdefault('threadlocals', True)
+        super(SharedSqliteDatabase, self).__init__(database, timeout=busy_timeout, **kwargs)
+
+    def _connect(self, database, **kwargs):
+        conn = super(SharedSqliteDatabase, self)._connect(database, **kwargs)
+        conn.execute('PRAGMA busy_timeout = {:d}'.format(int(self.busy_timeout * 1000)))
+        if self.read_only:
+            conn.execute('PRAGMA query_only = 1')
+        else:
+            # Only applies to new databases. Existing ones are converted with rollups.py --vacuum
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+
+def init_database(read_only=None):
+    """Returns the models database. Bot and web processes should pass read_only=True at startup."""
     global db
-    if db is not None:
-        return db
+    if db is None:
+        db = SharedSqliteDatabase(os.path.join(os.path.dirname(__file__), DATABASE))
+        log.info('Connecting to local SQLite database.')
+
+    if read_only is not None and read_only != db.read_only:
+        if not db.is_closed():
+            db.close()
+        db.read_only = read_only
+        log.info('Using {} SQLite connections.'.format('read-only' if read_only else 'read-write'))
+    return db
 
-    db = SqliteDatabase(os.path.join(os.path.dirname(__file__), DATABASE))
-    log.info('Connecting to local SQLite database.')
 
+def use_database(path):
+    """Points the models to another SQLite file (replays, benchmarks...)."""
+    init_database()
+    if not db.is_closed():
+        db.close()
+    db.init(path)
+    log.info('Using SQLite database {}.'.format(path))
     return db
 
 
+def gym_level(gym_points):
+    points_per_level = [2000, 4000, 8000, 12000, 16000, 20000, 30000, 40000, 50000]
+    level = 1
+    while level <= len(points_per_level) and gym_points >= points_per_level[level - 1]:
+        level += 1
+    return level
+
+
 def create_tables():
+    from migrations import migrate
+
     init_database()
     db.connect()
-    tables = [Trainer, Pokemon, Gym, GymMember, GymLog]
+    tables = [Trainer, Pokemon, Gym, GymMember, GymLog, TeamStats, TrainerStats, GymStatsHourly, GymStatsDaily,
+              RollupProgress, GymCheckpoint]
     # db.drop_tables(tables)
     db.create_tables(tables, safe=True)
+    migrate(db)
     db.close()
 
 
@@ -56,8 +111,11 @@ class Trainer(BaseModel):
 
     @classmethod
     def top_gyms_owned(cls):
-        return Trainer.select(Trainer, GymMember).join(GymMember).group_by(GymMember.trainer).order_by(
-            fn.COUNT(GymMember.trainer).desc())
+        """Trainers by number of gyms, available as trainer.gyms_count."""
+        return (Trainer.select(Trainer, TrainerStats.gyms.alias('gyms_count'))
+                .join(TrainerStats, on=(TrainerStats.trainer == Trainer.name))
+                .order_by(TrainerStats.gyms.desc())
+                .naive())
 
     def __repr__(self):
         return "Trainer(name={}, level={}))".format(self.name, self.level)
@@ -100,33 +158,34 @@ class Gym(BaseModel):
 
     @property
     def level(self):
-        points_per_level = [2000, 4000, 8000, 12000, 16000, 20000, 30000, 40000, 50000]
-        level = 1
-        while self.gym_points >= points_per_level[level - 1]:
-            level += 1
-        return level
+        return gym_level(self.gym_points)
 
     def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "description": self.description,
-            "team_id": self.team_id,
-            "gym_points": self.gym_points,
-            "latitude": self.latitude,
-            "longitude": self.longitude,
-            "last_modified": self.last_modified,
-            "last_checked": self.last_checked - timedelta(hours=+2),
-            "last_updated": self.last_updated,
-            "level": self.level,
-            "members_count": len(self.members),
-        }
+        return serialize_gym(self._data, len(self.members))
 
     def __repr__(self):
         return "Gym(id={}, name={}, team_id={}, gym_points={}, last_modified={}, members_count={}))".format(
             self.id, self.name.encode('utf-8'), self.team_id, self.gym_points, self.last_modified, len(self.members))
 
 
+def serialize_gym(gym, members_count):
+    """JSON-ready dict of a gym, given as a dict of Gym fields."""
+    return {
+        "id": gym['id'],
+        "name": gym['name'],
+        "description": gym['description'],
+        "team_id": gym['team_id'],
+        "gym_points": gym['gym_points'],
+        "latitude": gym['latitude'],
+        "longitude": gym['longitude'],
+        "last_modified": gym['last_modified'],
+        "last_checked": gym['last_checked'] - timedelta(hours=+2),
+        "last_updated": gym['last_updated'],
+        "level": gym_level(gym['gym_points']),
+        "members_count": members_count,
+    }
+
+
 class GymMember(BaseModel):
     trainer = ForeignKeyField(Trainer, related_name='gyms_membership')
     gym = ForeignKeyField(Gym, related_name='members')
@@ -138,6 +197,22 @@ class GymMember(BaseModel):
         # return "GymMember(trainer={}, gym={}, pokemon={}))".format(self.trainer, self.gym, self.pokemon)
 
 
+class TeamStats(BaseModel):
+    """Number of gyms of each team, kept up to date by the scanner."""
+    team_id = IntegerField(primary_key=True)
+    gyms = IntegerField(default=0)
+
+    @property
+    def team(self):
+        return TEAMS[self.team_id]
+
+
+class TrainerStats(BaseModel):
+    """Number of gyms of each trainer, kept up to date by the scanner."""
+    trainer = ForeignKeyField(Trainer, primary_key=True, related_name='stats')
+    gyms = IntegerField(default=0, index=True)
+
+
 class GymLog(BaseModel):
     IN_BATTLE = 'in_battle'
     STOP_BATTLE = 'stop_battle'
@@ -158,56 +233,124 @@ class GymLog(BaseModel):
     team_id = IntegerField(null=True)
 
 
-@db.transaction()
-def update_gym_members(gym_id, gym_members):
-    deleted_gym_members = DeleteQuery(GymMember).where(GymMember.gym == gym_id).execute()
-    if gym_members:  # Not insert if empty list
-        InsertQuery(GymMember, rows=gym_members).upsert().execute()
-    log.debug("Updated gym members from gym {} (deleted {})".format(gym_id, deleted_gym_members))
+class GymStats(BaseModel):
+    """Activity of a gym while owned by a team during a period, rolled up from GymLog (see rollups.py)."""
+    period_start = DateTimeField()
+    gym = ForeignKeyField(Gym)
+    team_id = IntegerField()
+    conquests = IntegerField(default=0)
+    points_gained = IntegerField(default=0)
+    points_lost = IntegerField(default=0)
+    battle_seconds = IntegerField(default=0)
 
+    @property
+    def team(self):
+        return TEAMS[self.team_id]
 
-def update_gyms(gyms, gym_members_dict):
-    actions = []
-    gym_members_to_update = []
-    for gym_id in gyms:
-        try:
-            gym = Gym.get(Gym.id == gym_id)
-            if gym.last_modified != gyms[gym_id]['last_modified']:
-                gym_actions = check_gym_changes(gym, gyms[gym_id], gym_members_dict[gym_id])
-                actions.extend(gym_actions)
-                gym_members_to_update.append(gym_id)
-        except DoesNotExist:
-            log.debug("Adding new gym: {}".format(gyms[gym_id]['name']))
-            gym_members_to_update.append(gym_id)
-
-    if gyms:
-        InsertQuery(Gym, rows=gyms.values()).upsert().execute()
-    if actions:
-        print(len(actions))
-        InsertQuery(GymLog, rows=actions).upsert().execute()
-
-    log.info("Upserted {} gyms".format(len(gyms)))
-
-    for gym_id in gym_members_to_update:
-        update_gym_members(gym_id, gym_members_dict[gym_id])
-    log.info("{} gyms modified".format(len(gym_members_to_update)))
-
-
-def check_gym_changes(gym, new_gym_dict, new_gym_members):
+
+class GymStatsHourly(GymStats):
+    class Meta:
+        primary_key = CompositeKey('period_start', 'gym', 'team_id')
+
+
+class GymStatsDaily(GymStats):
+    class Meta:
+        primary_key = CompositeKey('period_start', 'gym', 'team_id')
+
+
+class GymCheckpoint(BaseModel):
+    """Full state of every gym at a point in time, zlib-compressed json (see history.py)."""
+    timestamp = DateTimeField(index=True)
+    gyms = BlobField()
+
+
+class RollupProgress(BaseModel):
+    """End of the last period rolled up by each rollup."""
+    name = CharField(primary_key=True, max_length=20)
+    until = DateTimeField()
+
+
+def insert_many(model, rows, upsert=False, on_conflict=None):
+    """Inserts the rows in chunks small enough to stay under SQLite's variables limit."""
+    rows = list(rows)
+    if not rows:
+        return
+    chunk_size = max(SQLITE_MAX_VARIABLES // len(rows[0]), 1)
+    for idx in range(0, len(rows), chunk_size):
+        query = InsertQuery(model, rows=rows[idx:idx + chunk_size])
+        if upsert:
+            query = query.upsert()
+        elif on_conflict:
+            query = query.on_conflict(on_conflict)
+        query.execute()
+
+
+def apply_deltas(model, key_field, deltas):
+    """Adds deltas ({key: delta}) to the gyms column of an aggregate table, creating missing rows."""
+    deltas = dict((key, delta) for key, delta in deltas.iteritems() if delta)
+    if not deltas:
+        return
+    insert_many(model, [{key_field.name: key, 'gyms': 0} for key in deltas], on_conflict='IGNORE')
+    keys_by_delta = {}
+    for key, delta in deltas.iteritems():
+        keys_by_delta.setdefault(delta, []).append(key)
+    for delta, keys in keys_by_delta.iteritems():
+        for idx in range(0, len(keys), SQLITE_MAX_VARIABLES - 1):
+            model.update(gyms=model.gyms + delta).where(key_field << keys[idx:idx + SQLITE_MAX_VARIABLES - 1]).execute()
+    model.delete().where(model.gyms <= 0).execute()
+
+
+def delete_gym_members(gym_id, pokemon_ids):
+    for idx in range(0, len(pokemon_ids), SQLITE_MAX_VARIABLES - 1):
+        DeleteQuery(GymMember).where(
+            (GymMember.gym == gym_id) & (GymMember.pokemon << pokemon_ids[idx:idx + SQLITE_MAX_VARIABLES - 1])
+        ).execute()
+
+
+def update_gyms(gyms, trainers, pokemons, new_gym_members, lost_gym_members, actions,
+                team_deltas=None, trainer_deltas=None):
+    """Writes a whole scan batch in a single transaction.
+
+    new_gym_members is a list of GymMember rows to insert and lost_gym_members maps a gym id
+    to the pokemon ids that left it. team_deltas and trainer_deltas are the changes in the number
+    of gyms per team and per trainer, applied to TeamStats and TrainerStats.
+    """
+    with db.atomic():
+        insert_many(Trainer, trainers.values(), upsert=True)
+        insert_many(Pokemon, pokemons.values(), upsert=True)
+        insert_many(Gym, gyms.values(), upsert=True)
+        for gym_id, pokemon_ids in lost_gym_members.iteritems():
+            delete_gym_members(gym_id, pokemon_ids)
+        insert_many(GymMember, new_gym_members)
+        insert_many(GymLog, actions)
+        apply_deltas(TeamStats, TeamStats.team_id, team_deltas or {})
+        apply_deltas(TrainerStats, TrainerStats.trainer, trainer_deltas or {})
+
+    log.info("Upserted {} gyms, {} trainers and {} pokemons ({} new members, {} lost members, {} actions)".format(
+        len(gyms), len(trainers), len(pokemons), len(new_gym_members),
+        sum(len(pokemon_ids) for pokemon_ids in lost_gym_members.itervalues()), len(actions)))
+
+
+def check_gym_changes(gym, gym_members, new_gym_dict, new_gym_members):
+    """Compares the known state of a gym (dict of Gym fields and set of member trainer names)
+    with the new scanned one and returns the GymLog rows to insert.
+
+    team_id is the team owning the gym when the action happened (the new team for conquests).
+    """
     now = datetime.now()  # TODO mover a otro sitio
     new_last_modified = new_gym_dict['last_modified']
     new_team_id = new_gym_dict['team_id']
     new_is_in_battle = new_gym_dict['is_in_battle']
     new_gym_points = new_gym_dict['gym_points']
-    points_change = new_gym_points - gym.gym_points
+    points_change = new_gym_points - gym['gym_points']
 
     print "-"*30
-    print gym.name.encode('utf-8')
-    print "Last modified:", gym.last_modified, new_last_modified
-    print "Team: ", gym.team_id, new_team_id
-    print "Is in battle:", gym.is_in_battle, new_is_in_battle
-    print "Gym_points:", gym.gym_points, new_gym_points
-    print "Members:", len(gym.members), len(new_gym_members)
+    print gym['name'].encode('utf-8')
+    print "Last modified:", gym['last_modified'], new_last_modified
+    print "Team: ", gym['team_id'], new_team_id
+    print "Is in battle:", gym['is_in_battle'], new_is_in_battle
+    print "Gym_points:", gym['gym_points'], new_gym_points
+    print "Members:", len(gym_members), len(new_gym_members)
 
     actions = []
 
@@ -215,72 +358,72 @@ def check_gym_changes(gym, new_gym_dict, new_gym_members):
         print "GYM IS BEEN ATTACKED NOW!"
         actions.append({
             'timestamp': now,
-            'gym': gym.id,
+            'gym': gym['id'],
             'action': GymLog.IN_BATTLE,
             'trainer': None,
             'points_change': None,
             'gym_points': None,
             'old_team_id': None,
-            'team_id': None
+            'team_id': new_team_id
         })
 
-    if gym.is_in_battle is True and new_is_in_battle is False:
+    if gym['is_in_battle'] is True and new_is_in_battle is False:
         print "STOPPED ATTACK..."
         actions.append({
             'timestamp': now,
-            'gym': gym.id,
+            'gym': gym['id'],
             'action': GymLog.STOP_BATTLE,
             'trainer': None,
             'points_change': None,
             'gym_points': None,
             'old_team_id': None,
-            'team_id': None
+            'team_id': new_team_id
         })
 
-    if gym.team_id == new_team_id and points_change > 0:
+    if gym['team_id'] == new_team_id and points_change > 0:
         print "GYM TRAINED ({:+d} points)".format(points_change)
         actions.append({
             'timestamp': now,
-            'gym': gym.id,
+            'gym': gym['id'],
             'action': GymLog.GYM_TRAINED,
             'trainer': None,
             'points_change': points_change,
             'gym_points': new_gym_points,
             'old_team_id': None,
-            'team_id': None
+            'team_id': new_team_id
         })
 
-    if gym.team_id == new_team_id and points_change < 0:
+    if gym['team_id'] == new_team_id and points_change < 0:
         print "GYM ATTACKED ({} points)".format(points_change)
         actions.append({
             'timestamp': now,
-            'gym': gym.id,
+            'gym': gym['id'],
             'action': GymLog.GYM_ATTACKED,
             'trainer': None,
             'points_change': points_change,
             'gym_points': new_gym_points,
             'old_team_id': None,
-            'team_id': None
+            'team_id': new_team_id
         })
 
-    if gym.team_id != new_team_id:
+    if gym['team_id'] != new_team_id:
         if new_team_id == 0:
             print "GYM IS NEUTRAL NOW"
         else:
             print "GYM CONQUESTED BY TEAM {}".format(TEAMS[new_team_id])
         actions.append({
             'timestamp': now,
-            'gym': gym.id,
+            'gym': gym['id'],
             'action': GymLog.GYM_CONQUESTED,
             'trainer': None,
             'points_change': None,
             'gym_points': new_gym_points,
-            'old_team_id': gym.team_id,
+            'old_team_id': gym['team_id'],
             'team_id': new_team_id
         })
 
-    if gym.team_id != new_team_id or len(gym.members) != len(new_gym_members):
-        old_members = set([gym_member.trainer.name for gym_member in list(gym.members)])
+    if gym['team_id'] != new_team_id or len(gym_members) != len(new_gym_members):
+        old_members = set(gym_members)
         new_members = set([member['trainer'] for member in new_gym_members])
         new_members_in_gym = list(new_members - old_members)
         lost_members_in_gym = list(old_members - new_members)
@@ -289,37 +432,37 @@ def check_gym_changes(gym, new_gym_dict, new_gym_members):
             for member in new_members_in_gym:
                 actions.append({
                     'timestamp': now,
-                    'gym': gym.id,
+                    'gym': gym['id'],
                     'action': GymLog.NEW_GYM_MEMBER,
                     'trainer': member,
                     'points_change': None,
                     'gym_points': new_gym_points,
                     'old_team_id': None,
-                    'team_id': None
+                    'team_id': new_team_id
                 })
         if lost_members_in_gym:
             print "LOST GYM MEMBERS:", lost_members_in_gym
             for member in lost_members_in_gym:
                 actions.append({
                     'timestamp': now,
-                    'gym': gym.id,
+                    'gym': gym['id'],
                     'action': GymLog.LOST_GYM_MEMBER,
                     'trainer': member,
                     'points_change': None,
                     'gym_points': None,
                     'old_team_id': None,
-                    'team_id': None
+                    'team_id': gym['team_id']
                 })
 
         # print "Old members:"
-        # pprint(list(gym.members))
+        # pprint(gym_members)
         # print "New members:"
         # pprint(new_gym_members)
 
     # if not actions:
     #     actions.append({
     #         'timestamp': now,
-    #         'gym': gym.id,
+    #         'gym': gym['id'],
     #         'action': GymLog.UNKNOWN,
     #         'trainer': None,
     #         'points_change': None,
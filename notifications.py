@@ -0,0 +1,246 @@
+# coding: utf-8
+"""Notifications of the gym events to the bot chats following gyms, trainers or areas.
+
+The scanner writes every event it detects to GymLog. The Notifier tails it every few seconds
+and fans each batch out in a single pass over an inverted index from gym and trainer to the
+following chats, so each chat gets at most one message per batch, with the events of each gym
+coalesced.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from config import SUBSCRIPTIONS_FILE, MAX_SUBSCRIPTIONS, NOTIFY_INTERVAL, NOTIFY_RATE, NOTIFY_BATCH_SIZE
+from models import GymLog
+from ratelimit import TokenBucket
+from route import distance
+
+log = logging.getLogger(__name__)
+
+SUBSCRIPTIONS_PATH = os.path.join(os.path.dirname(__file__), SUBSCRIPTIONS_FILE)
+GYM = 'gym'
+TRAINER = 'trainer'
+AREA = 'area'
+
+NOTIFIED_ACTIONS = (GymLog.GYM_CONQUESTED, GymLog.GYM_TRAINED, GymLog.GYM_ATTACKED, GymLog.NEW_GYM_MEMBER,
+                    GymLog.LOST_GYM_MEMBER)
+
+
+def gyms_in_area(gyms, latitude, longitude, radius):
+    """Ids of the gyms (LiveGym) within radius meters of the point."""
+    return [gym.id for gym in gyms if distance(latitude, longitude, gym.latitude, gym.longitude) <= radius]
+
+
+class Subscriptions(object):
+    """Gyms, trainers and areas followed by each chat, saved to a json file.
+
+    Areas are stored with the ids of the gyms inside them, so the inverted indexes only map gyms
+    and trainers to chats. The indexes are rebuilt on every change and swapped, so the notifier
+    can read them without locking.
+    """
+
+    def __init__(self, path=SUBSCRIPTIONS_PATH, max_subscriptions=MAX_SUBSCRIPTIONS):
+        self.path = path
+        self.max_subscriptions = max_subscriptions
+        self.chats = {}  # chat_id -> [{'kind': GYM/TRAINER/AREA, 'key': gym id/trainer name/[lat, lng, radius],
+        #                               'name': label, 'gyms': [gym ids] (areas)}]
+        self.by_gym = {}  # gym_id -> set of chat ids
+        self.by_trainer = {}  # trainer name -> set of chat ids
+        self.lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        return sum(len(subscriptions) for subscriptions in self.chats.itervalues())
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path) as fp:
+            data = json.load(fp)
+        self.chats = dict((int(chat_id), subscriptions) for chat_id, subscriptions in data.iteritems())
+        self._reindex()
+        log.info("Loaded {} subscriptions of {} chats".format(len(self), len(self.chats)))
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.chats, fp)
+        os.rename(tmp_path, self.path)
+
+    def _reindex(self):
+        by_gym = defaultdict(set)
+        by_trainer = defaultdict(set)
+        for chat_id, subscriptions in self.chats.iteritems():
+            for subscription in subscriptions:
+                if subscription['kind'] == GYM:
+                    by_gym[subscription['key']].add(chat_id)
+                elif subscription['kind'] == AREA:
+                    for gym_id in subscription['gyms']:
+                        by_gym[gym_id].add(chat_id)
+                else:
+                    by_trainer[subscription['key']].add(chat_id)
+        self.by_gym = dict(by_gym)
+        self.by_trainer = dict(by_trainer)
+
+    def subscribe(self, chat_id, kind, key, name, gyms=None):
+        """Follows a gym, trainer or area. Returns False if already followed or over the limit."""
+        with self.lock:
+            subscriptions = self.chats.get(chat_id, [])
+            if len(subscriptions) >= self.max_subscriptions or \
+                    any(item['kind'] == kind and item['key'] == key for item in subscriptions):
+                return False
+            subscription = {'kind': kind, 'key': key, 'name': name}
+            if gyms is not None:
+                subscription['gyms'] = gyms
+            self.chats[chat_id] = subscriptions + [subscription]
+            self._reindex()
+            self.save()
+        return True
+
+    def unsubscribe(self, chat_id, idx=None):
+        """Stops following the subscription at idx (all of them if None). Returns the removed ones."""
+        with self.lock:
+            subscriptions = self.chats.get(chat_id, [])
+            if idx is None:
+                removed = subscriptions
+                remaining = []
+            elif 0 <= idx < len(subscriptions):
+                removed = [subscriptions[idx]]
+                remaining = subscriptions[:idx] + subscriptions[idx + 1:]
+            else:
+                return []
+            if remaining:
+                self.chats[chat_id] = remaining
+            else:
+                self.chats.pop(chat_id, None)
+            if removed:
+                self._reindex()
+                self.save()
+        return removed
+
+    def subscriptions(self, chat_id):
+        return list(self.chats.get(chat_id, []))
+
+
+def summarize(events):
+    """Coalesces the events (GymLog tuples) of a batch per gym.
+
+    Returns an OrderedDict of gym_id -> {'old_team_id', 'team_id' (set only if the owner changed),
+    'points' (net change while owned by the same team), 'joined' and 'left' (trainer names)}.
+    """
+    gyms = OrderedDict()
+    for _, gym_id, action, trainer, points_change, old_team_id, team_id in events:
+        summary = gyms.get(gym_id)
+        if summary is None:
+            summary = gyms[gym_id] = {'old_team_id': None, 'team_id': None, 'points': 0,
+                                      'joined': set(), 'left': set()}
+        if action == GymLog.GYM_CONQUESTED:
+            if summary['old_team_id'] is None:
+                summary['old_team_id'] = old_team_id
+            summary['team_id'] = team_id
+            summary['points'] = 0
+        elif action in (GymLog.GYM_TRAINED, GymLog.GYM_ATTACKED):
+            summary['points'] += points_change or 0
+        elif action == GymLog.NEW_GYM_MEMBER:
+            if trainer in summary['left']:
+                summary['left'].discard(trainer)
+            else:
+                summary['joined'].add(trainer)
+        elif action == GymLog.LOST_GYM_MEMBER:
+            if trainer in summary['joined']:
+                summary['joined'].discard(trainer)
+            else:
+                summary['left'].add(trainer)
+
+    for summary in gyms.itervalues():
+        if summary['team_id'] is not None and summary['team_id'] == summary['old_team_id']:
+            summary['team_id'] = summary['old_team_id'] = None  # Lost and retaken
+    return OrderedDict((gym_id, summary) for gym_id, summary in gyms.iteritems()
+                       if summary['team_id'] is not None or summary['points'] or summary['joined'] or
+                       summary['left'])
+
+
+def fan_out(summaries, by_gym, by_trainer):
+    """Groups the gym summaries per following chat in one pass over them.
+
+    Returns a dict of chat_id -> (gym ids followed, [(trainer, gym_id, joined)] of the trainers followed).
+    """
+    chats = defaultdict(lambda: ([], []))
+    for gym_id, summary in summaries.iteritems():
+        for chat_id in by_gym.get(gym_id, ()):
+            chats[chat_id][0].append(gym_id)
+        for key, joined in (('joined', True), ('left', False)):
+            for trainer in summary[key]:
+                for chat_id in by_trainer.get(trainer, ()):
+                    if gym_id not in chats[chat_id][0]:
+                        chats[chat_id][1].append((trainer, gym_id, joined))
+    return chats
+
+
+class Notifier(object):
+    """Tails GymLog and sends each chat the events of what it follows, at most once per interval.
+
+    send(chat_id, summaries, gym_ids, trainer_events) delivers a message; it is called at most
+    rate times per second (the Telegram limit for a bot is around 30 messages/s).
+    """
+
+    def __init__(self, subscriptions, send, interval=NOTIFY_INTERVAL, rate=NOTIFY_RATE,
+                 batch_size=NOTIFY_BATCH_SIZE):
+        self.subscriptions = subscriptions
+        self.send = send
+        self.interval = interval
+        self.batch_size = batch_size
+        self.bucket = TokenBucket(rate, capacity=rate)
+        self.last_id = None
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='notifier')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                while self.notify_new_events() >= self.batch_size:
+                    pass
+            except Exception:
+                log.exception("Error sending notifications")
+
+    def new_events(self):
+        if self.last_id is None:  # Only the events from now on
+            last_event = GymLog.select(GymLog.id).order_by(GymLog.id.desc()).first()
+            self.last_id = last_event.id if last_event is not None else 0
+            return []
+        events = list(GymLog
+                      .select(GymLog.id, GymLog.gym, GymLog.action, GymLog.trainer, GymLog.points_change,
+                              GymLog.old_team_id, GymLog.team_id)
+                      .where((GymLog.id > self.last_id) & (GymLog.action << NOTIFIED_ACTIONS))
+                      .order_by(GymLog.id)
+                      .limit(self.batch_size)
+                      .tuples())
+        if events:
+            self.last_id = events[-1][0]
+        return events
+
+    def notify_new_events(self):
+        """Sends the notifications of the events since the last call. Returns the number of events read."""
+        events = self.new_events()
+        if not events or not len(self.subscriptions):
+            return len(events)
+        summaries = summarize(events)
+        chats = fan_out(summaries, self.subscriptions.by_gym, self.subscriptions.by_trainer)
+        for chat_id, (gym_ids, trainer_events) in chats.iteritems():
+            self.bucket.acquire()
+            try:
+                self.send(chat_id, summaries, gym_ids, trainer_events)
+            except Exception as ex:
+                log.warn("Error notifying chat {}: {}".format(chat_id, ex))
+        log.info("Notified {} chats of {} events".format(len(chats), len(events)))
+        return len(events)
@@ -0,0 +1,97 @@
+# coding: utf-8
+"""Opt-in SQL profiler for the models database.
+
+Wrap a bot command or web request with profile(name) (or the profiled decorator) to log how many
+statements it ran and how long they took, the statements slower than SLOW_QUERY_THRESHOLD and the
+statements repeated N_PLUS_ONE_THRESHOLD times or more (usually lazy loads inside a loop).
+Does nothing unless PROFILE_QUERIES is enabled.
+"""
+import functools
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from config import PROFILE_QUERIES, SLOW_QUERY_THRESHOLD, N_PLUS_ONE_THRESHOLD
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class QueryProfile(object):
+    def __init__(self, name):
+        self.name = name
+        self.queries = []  # (sql, params, seconds)
+
+    def record(self, sql, params, seconds):
+        self.queries.append((sql, params, seconds))
+
+    @property
+    def total_time(self):
+        return sum(seconds for _, _, seconds in self.queries)
+
+    def repeated_shapes(self, threshold=N_PLUS_ONE_THRESHOLD):
+        # peewee always uses placeholders, so the sql text is the shape of the query
+        shapes = Counter(sql for sql, _, _ in self.queries)
+        return [(sql, count) for sql, count in shapes.most_common() if count >= threshold]
+
+    def report(self, slow_threshold=SLOW_QUERY_THRESHOLD):
+        log.info("{}: {} queries in {:.1f}ms".format(self.name, len(self.queries), self.total_time * 1000))
+        for sql, params, seconds in self.queries:
+            if seconds >= slow_threshold:
+                log.warn("{}: slow query ({:.1f}ms): {} {}".format(self.name, seconds * 1000, sql, params))
+        for sql, count in self.repeated_shapes():
+            log.warn("{}: possible N+1, query run {} times: {}".format(self.name, count, sql))
+
+
+def install(database):
+    """Wraps database.execute_sql to record the statements of the active profile, if any.
+
+    Only the execution of the statement is timed, not fetching its rows.
+    """
+    if getattr(database, 'profiler_installed', False):
+        return
+    execute_sql = database.execute_sql
+
+    def profiled_execute_sql(sql, params=None, *args, **kwargs):
+        profile = getattr(_local, 'profile', None)
+        if profile is None:
+            return execute_sql(sql, params, *args, **kwargs)
+        start = time.time()
+        try:
+            return execute_sql(sql, params, *args, **kwargs)
+        finally:
+            profile.record(sql, params, time.time() - start)
+
+    database.execute_sql = profiled_execute_sql
+    database.profiler_installed = True
+
+
+@contextmanager
+def profile(name, enabled=PROFILE_QUERIES):
+    if not enabled:
+        yield None
+        return
+
+    from models import init_database
+    install(init_database())
+    previous = getattr(_local, 'profile', None)
+    _local.profile = QueryProfile(name)
+    try:
+        yield _local.profile
+    finally:
+        _local.profile.report()
+        _local.profile = previous
+
+
+def profiled(name):
+    """Decorator version of profile()."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,184 @@
+# coding: utf-8
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from config import MIN_REQUEST_RATE, MAX_REQUEST_RATE, RATE_INCREASE, RATE_DECREASE, RETRY_QUEUE_FILE, \
+    RETRY_BASE_DELAY, RETRY_MAX_DELAY, MAX_RETRIES, DEAD_GYM_PROBE_INTERVAL
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket. acquire() blocks until a token is available."""
+
+    def __init__(self, rate, capacity=1.0):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Takes a token, waiting for it if needed. Returns the seconds waited."""
+        with self.lock:
+            self._refill(time.time())
+            self.tokens -= 1  # Reserve the token, even if it is not available yet
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def try_acquire(self):
+        """Takes a token if one is available, without waiting. Returns whether it took it."""
+        with self.lock:
+            self._refill(time.time())
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class AdaptiveRateController(TokenBucket):
+    """Token bucket whose rate follows the throttling seen: additive increase, multiplicative decrease (AIMD).
+
+    Each successful request adds increase / rate to the rate, so it grows by about `increase`
+    requests/s every second. Each throttled request multiplies it by `decrease`.
+    """
+
+    def __init__(self, rate, min_rate=MIN_REQUEST_RATE, max_rate=MAX_REQUEST_RATE,
+                 increase=RATE_INCREASE, decrease=RATE_DECREASE):
+        super(AdaptiveRateController, self).__init__(min(max(rate, min_rate), max_rate))
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+
+    def _set_rate(self, rate):
+        self._refill(time.time())
+        self.rate = min(max(rate, self.min_rate), self.max_rate)
+
+    def on_success(self):
+        with self.lock:
+            self._set_rate(self.rate + self.increase / self.rate)
+
+    def on_throttle(self):
+        with self.lock:
+            self._set_rate(self.rate * self.decrease)
+            self.tokens = min(self.tokens, 0)
+        log.info("Request rate lowered to {:.2f} requests/s".format(self.rate))
+
+
+class RetryQueue(object):
+    """Gyms whose scan failed, retried with jittered exponential backoff.
+
+    Gyms failing on their own (no gym state in the response) more than max_retries times in a row
+    go to the dead-letter list. Transient failures (login, throttling, network) only back off, so
+    an outage does not kill any gym. Dead gyms are probed again every probe_interval seconds and
+    leave the list when a probe succeeds. Both are saved to a json file so they survive restarts.
+    """
+
+    def __init__(self, path=RETRY_QUEUE_FILE, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 max_retries=MAX_RETRIES, probe_interval=DEAD_GYM_PROBE_INTERVAL):
+        self.path = path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.probe_interval = probe_interval
+        # gym_id -> {'gym': gym, 'attempts': n, 'failures': n, 'next_try': timestamp, 'error': str}
+        self.pending = {}
+        self.dead = {}  # gym_id -> {'gym': gym, 'attempts': n, 'next_try': timestamp (next probe), 'error': str}
+        self.in_flight = set()
+        self.dirty = False
+        self.random = random.Random()
+        self.load()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __contains__(self, gym_id):
+        return gym_id in self.pending
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path) as fp:
+            data = json.load(fp)
+        for key in ('pending', 'dead'):
+            for gym_id, entry in data.get(key, {}).iteritems():
+                entry['gym'] = tuple(entry['gym'])
+                getattr(self, key)[gym_id] = entry
+        for entry in self.dead.itervalues():
+            if 'next_try' not in entry:  # Spread the first probes of the gyms given up before probing existed
+                entry['next_try'] = time.time() + self.random.uniform(0, self.probe_interval)
+        log.info("Loaded {} gyms to retry and {} dead gyms".format(len(self.pending), len(self.dead)))
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump({'pending': self.pending, 'dead': self.dead}, fp)
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+    def failed(self, gym, error=None, transient=False):
+        """Queues the gym to retry. Transient failures do not count towards max_retries."""
+        gym_id = gym[0]
+        self.in_flight.discard(gym_id)
+        self.dirty = True
+        if gym_id in self.dead:  # Failed probe
+            entry = self.dead[gym_id]
+            entry['error'] = error
+            entry['next_try'] = time.time() + (self.max_delay if transient else self.probe_interval)
+            return
+        entry = self.pending.pop(gym_id, None) or {'gym': gym, 'attempts': 0}
+        entry['failures'] = entry.get('failures', 0) + 1
+        entry['error'] = error
+        if not transient:
+            entry['attempts'] += 1
+        if entry['attempts'] > self.max_retries:
+            entry.pop('failures')
+            entry['next_try'] = time.time() + self.probe_interval
+            self.dead[gym_id] = entry
+            log.warn("Gym {} failed {} times. Moved to dead-letter list".format(gym_id, entry['attempts']))
+            return
+        delay = min(self.base_delay * 2 ** min(entry['failures'] - 1, 20), self.max_delay)
+        entry['next_try'] = time.time() + delay * self.random.uniform(0.5, 1.5)
+        self.pending[gym_id] = entry
+
+    def succeeded(self, gym_id):
+        """Forgets the failures of the gym. Returns True if it was a dead gym."""
+        self.in_flight.discard(gym_id)
+        if self.pending.pop(gym_id, None) is not None:
+            self.dirty = True
+        if self.dead.pop(gym_id, None) is not None:
+            self.dirty = True
+            log.info("Dead gym {} answered again. Removed from the dead-letter list".format(gym_id))
+            return True
+        return False
+
+    def _entries(self):
+        return itertools.chain(self.pending.iteritems(), self.dead.iteritems())
+
+    def pop_due(self, limit):
+        """Returns up to `limit` gyms to retry (or probe) now. They stay queued until they fail or succeed again."""
+        now = time.time()
+        due = sorted((entry['next_try'], gym_id, entry['gym']) for gym_id, entry in self._entries()
+                     if entry['next_try'] <= now and gym_id not in self.in_flight)[:limit]
+        self.in_flight.update(gym_id for _, gym_id, _ in due)
+        return [gym for _, _, gym in due]
+
+    def seconds_until_due(self, default):
+        next_tries = [entry['next_try'] for gym_id, entry in self._entries() if gym_id not in self.in_flight]
+        if not next_tries:
+            return default
+        return max(min(next_tries) - time.time(), 0)
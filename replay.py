@@ -0,0 +1,77 @@
+# coding: utf-8
+import argparse
+import logging
+import time
+
+from archive import ResponseArchive
+from city_state import CityState
+from gyms_scanner import parse_and_insert_to_database, read_data_from_json
+from models import create_tables, use_database
+from utils import setup_logging
+
+log = logging.getLogger(__name__)
+
+
+def iter_recorded(paths):
+    """Streams the GET_GYM_DETAILS responses saved in json files (the gym_details.json dumps of the scanner before the archive)."""
+    for path in paths:
+        data = read_data_from_json(path)
+        if isinstance(data, dict):  # Single response
+            data = [data]
+        for gym_detail in data:
+            yield gym_detail
+
+
+def iter_archived(path, start_ms=None, end_ms=None):
+    """Streams the responses stored in a ResponseArchive."""
+    for _, gym_detail in ResponseArchive(path).responses(start_ms, end_ms):
+        yield gym_detail
+
+
+def replay(gym_details, state, batch_size=100, timings=None):
+    """Pushes the responses through the ingest pipeline without network or delays.
+
+    Returns the number of responses processed and the ids of the modified gyms.
+    """
+    count = 0
+    modified_gyms = set()
+    batch = []
+    for gym_detail in gym_details:
+        batch.append(gym_detail)
+        if len(batch) >= batch_size:
+            modified_gyms |= parse_and_insert_to_database(batch, state, timings)
+            count += len(batch)
+            batch = []
+    if batch:
+        modified_gyms |= parse_and_insert_to_database(batch, state, timings)
+        count += len(batch)
+    return count, modified_gyms
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded gym details into the database")
+    parser.add_argument('paths', nargs='*', help="json files with recorded GET_GYM_DETAILS responses")
+    parser.add_argument('--archive', help="replay the responses stored in this archive directory")
+    parser.add_argument('--database', help="SQLite file to write to (default: the configured one)")
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+
+    setup_logging()
+    if args.database:
+        use_database(args.database)
+    create_tables()
+    state = CityState.load()
+
+    timings = {}
+    start = time.time()
+    gym_details = iter_archived(args.archive) if args.archive else iter_recorded(args.paths)
+    count, modified_gyms = replay(gym_details, state, args.batch_size, timings)
+    elapsed = time.time() - start
+    log.info("Replayed {} responses ({} modified gyms) in {:.2f}s ({:.1f} gyms/s)".format(
+        count, len(modified_gyms), elapsed, count / elapsed if elapsed else 0))
+    for stage in sorted(timings):
+        log.info("  {:6} {:.3f}s".format(stage, timings[stage]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+# coding: utf-8
+"""Hourly and daily rollups of GymLog, and retention of the raw rows.
+
+For each gym and owning team, the rollups count the conquests, the points gained by training and
+lost by attacks, and the seconds in battle (the time between consecutive in battle scans of a gym,
+up to MAX_BATTLE_GAP). Only complete periods are rolled up, so every period is built once.
+Raw GymLog rows and hourly rollups older than their retention are deleted once rolled up, in small
+transactions, and the freed pages are returned to the filesystem with incremental vacuum.
+
+Old GymLog rows may lack the team. Those are counted for the current team of the gym.
+"""
+import argparse
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from peewee import fn
+
+from config import ROLLUP_INTERVAL, GYM_LOG_RETENTION, HOURLY_ROLLUP_RETENTION, MAX_BATTLE_GAP, \
+    PRUNE_BATCH_SIZE
+from history import prune_checkpoints
+from models import Gym, GymLog, GymStatsHourly, GymStatsDaily, RollupProgress, init_database, insert_many
+
+log = logging.getLogger(__name__)
+
+DAY = timedelta(days=1)
+STATS_FIELDS = ('conquests', 'points_gained', 'points_lost', 'battle_seconds')
+
+
+def hour_start(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def day_start(timestamp):
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_progress(name):
+    progress = RollupProgress.select().where(RollupProgress.name == name).first()
+    return progress.until if progress is not None else None
+
+
+def set_progress(name, until):
+    insert_many(RollupProgress, [{'name': name, 'until': until}], upsert=True)
+
+
+def new_stats():
+    return dict.fromkeys(STATS_FIELDS, 0)
+
+
+def aggregate_gym_log(start, end, max_battle_gap=MAX_BATTLE_GAP):
+    """Returns the hourly stats of [start, end) as {(hour, gym_id, team_id): stats}."""
+    max_gap = timedelta(seconds=max_battle_gap)
+    query = (GymLog.select(GymLog.gym, GymLog.timestamp, GymLog.action, GymLog.points_change,
+                           fn.COALESCE(GymLog.team_id, Gym.team_id))
+             .join(Gym)
+             .where((GymLog.timestamp >= start - max_gap) & (GymLog.timestamp < end))
+             .order_by(GymLog.timestamp)
+             .tuples())
+    stats = defaultdict(new_stats)
+    last_battle = {}  # gym id -> timestamp of its last in battle scan
+    for gym_id, timestamp, action, points_change, team_id in query:
+        if action in (GymLog.IN_BATTLE, GymLog.STOP_BATTLE):
+            since = last_battle.pop(gym_id, None)
+            if since is not None and timestamp >= start and timestamp - since <= max_gap:
+                stats[(hour_start(timestamp), gym_id, team_id)]['battle_seconds'] += \
+                    int((timestamp - since).total_seconds())
+            if action == GymLog.IN_BATTLE:
+                last_battle[gym_id] = timestamp
+        # Earlier rows only give the start of the battles in progress
+        if timestamp < start:
+            continue
+        key = (hour_start(timestamp), gym_id, team_id)
+        if action == GymLog.GYM_CONQUESTED:
+            stats[key]['conquests'] += 1
+        elif action == GymLog.GYM_TRAINED:
+            stats[key]['points_gained'] += points_change
+        elif action == GymLog.GYM_ATTACKED:
+            stats[key]['points_lost'] -= points_change
+    return stats
+
+
+def aggregate_hourly(start, end):
+    """Returns the daily stats of [start, end) as {(day, gym_id, team_id): stats}, from the hourly rollups."""
+    query = (GymStatsHourly.select(GymStatsHourly.period_start, GymStatsHourly.gym, GymStatsHourly.team_id,
+                                   *[getattr(GymStatsHourly, field) for field in STATS_FIELDS])
+             .where((GymStatsHourly.period_start >= start) & (GymStatsHourly.period_start < end))
+             .tuples())
+    stats = defaultdict(new_stats)
+    for row in query:
+        day_stats = stats[(day_start(row[0]), row[1], row[2])]
+        for field, value in zip(STATS_FIELDS, row[3:]):
+            day_stats[field] += value
+    return stats
+
+
+def save_stats(model, stats):
+    rows = []
+    for (period_start, gym_id, team_id), values in stats.iteritems():
+        row = {'period_start': period_start, 'gym': gym_id, 'team_id': team_id}
+        row.update(values)
+        rows.append(row)
+    insert_many(model, rows, upsert=True)
+
+
+def rollup(name, model, aggregate, truncate, first_timestamp, now):
+    """Rolls up the complete periods not rolled up yet, one day at most per transaction."""
+    end = truncate(now)
+    start = get_progress(name)
+    if start is None:
+        if first_timestamp is None:
+            return 0
+        start = truncate(first_timestamp)
+    rows = 0
+    while start < end:
+        chunk_end = min(start + DAY, end)
+        with init_database().atomic():
+            stats = aggregate(start, chunk_end)
+            save_stats(model, stats)
+            set_progress(name, chunk_end)
+        rows += len(stats)
+        start = chunk_end
+    return rows
+
+
+def rollup_hours(now=None):
+    first = GymLog.select(GymLog.timestamp).order_by(GymLog.timestamp).first()
+    return rollup('hourly', GymStatsHourly, aggregate_gym_log, hour_start,
+                  first.timestamp if first is not None else None, now or datetime.now())
+
+
+def rollup_days(now=None):
+    # Days are built from the hourly rollups, so they can not go beyond them
+    until = get_progress('hourly')
+    if until is None:
+        return 0
+    first = GymStatsHourly.select(GymStatsHourly.period_start).order_by(GymStatsHourly.period_start).first()
+    return rollup('daily', GymStatsDaily, aggregate_hourly, day_start,
+                  first.period_start if first is not None else None, min(now or datetime.now(), until))
+
+
+def prune(model, timestamp_field, before, batch_size=PRUNE_BATCH_SIZE):
+    """Deletes the rows older than `before` in transactions of batch_size rows. Returns the rows deleted."""
+    sql = 'DELETE FROM "{0}" WHERE rowid IN (SELECT rowid FROM "{0}" WHERE "{1}" < ? LIMIT ?)'.format(
+        model._meta.db_table, timestamp_field.db_column)
+    deleted = 0
+    while True:
+        with init_database().atomic():
+            count = init_database().execute_sql(sql, (timestamp_field.db_value(before), batch_size)).rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def compact(database, pages=1000):
+    """Returns up to `pages` free pages to the filesystem (only with auto_vacuum = INCREMENTAL)."""
+    # The pragma frees one page per step, so the cursor must be consumed
+    database.execute_sql('PRAGMA incremental_vacuum({:d})'.format(pages)).fetchall()
+
+
+def maintain(now=None, log_retention=GYM_LOG_RETENTION, hourly_retention=HOURLY_ROLLUP_RETENTION):
+    """Builds the pending rollups and prunes the rows past retention that are already rolled up.
+
+    Checkpoints past the GymLog retention are thinned to one per day, as they can no longer be replayed.
+    """
+    now = now or datetime.now()
+    database = init_database()
+    hours = rollup_hours(now)
+    days = rollup_days(now)
+    log_before = min(now - timedelta(days=log_retention), get_progress('hourly') or datetime.min)
+    hourly_before = min(now - timedelta(days=hourly_retention), get_progress('daily') or datetime.min)
+    pruned_log = prune(GymLog, GymLog.timestamp, log_before)
+    pruned_hourly = prune(GymStatsHourly, GymStatsHourly.period_start, hourly_before)
+    pruned_checkpoints = prune_checkpoints(now - timedelta(days=log_retention))
+    if pruned_log or pruned_hourly or pruned_checkpoints:
+        compact(database)
+    log.info("Rollups: {} hourly and {} daily rows built, {} GymLog rows, {} hourly rows and {} checkpoints "
+             "pruned".format(hours, days, pruned_log, pruned_hourly, pruned_checkpoints))
+
+
+def start_maintenance(interval=ROLLUP_INTERVAL):
+    """Runs maintain() every `interval` seconds in a background thread of the writer process."""
+    def run():
+        while True:
+            try:
+                maintain()
+            except Exception:
+                log.exception("GymLog rollup failed")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='rollups')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def history(gym_id, start, end, daily=False):
+    """Rolled up stats of a gym between two datetimes, by hour or by day."""
+    model = GymStatsDaily if daily else GymStatsHourly
+    return (model.select()
+            .where((model.gym == gym_id) & (model.period_start >= start) & (model.period_start < end))
+            .order_by(model.period_start))
+
+
+def main():
+    from models import create_tables, use_database
+    from utils import setup_logging
+
+    parser = argparse.ArgumentParser(description="Build the GymLog rollups and prune old rows")
+    parser.add_argument('--database', help="SQLite file (default: the configured one)")
+    parser.add_argument('--vacuum', action='store_true',
+                        help="enable incremental vacuum on an existing database and rebuild it (slow)")
+    args = parser.parse_args()
+
+    setup_logging()
+    if args.database:
+        use_database(args.database)
+    create_tables()
+    maintain()
+    if args.vacuum:
+        database = init_database()
+        database.execute_sql('PRAGMA auto_vacuum = INCREMENTAL')
+        database.execute_sql('VACUUM')
+    init_database().close()
+
+
+if __name__ == '__main__':
+    main()
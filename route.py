@@ -0,0 +1,181 @@
+# coding: utf-8
+import logging
+import math
+
+from config import MAX_TRAVEL_SPEED
+
+log = logging.getLogger(__name__)
+
+EARTH_RADIUS = 6371000.0  # meters
+# Size of the spatial index cells, in degrees (~500m)
+GRID_CELL_SIZE = 0.005
+# Max distance (in tour positions) between the two edges swapped by 2-opt
+TWO_OPT_WINDOW = 50
+TWO_OPT_PASSES = 3
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """Equirectangular approximation of the distance in meters, good enough inside a city."""
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.sqrt(x * x + y * y) * EARTH_RADIUS
+
+
+def task_position(task):
+    """Position of a gym (gym_id, latitude, longitude) or a MapRequest."""
+    if hasattr(task, 'latitude'):
+        return task.latitude, task.longitude
+    return task[1], task[2]
+
+
+def travel_time(position, task, max_speed=MAX_TRAVEL_SPEED):
+    """Seconds needed to move from a position to a task without going over max_speed (m/s)."""
+    if position is None or not max_speed:
+        return 0
+    latitude, longitude = task_position(task)
+    return distance(position[0], position[1], latitude, longitude) / max_speed
+
+
+class GridIndex(object):
+    """Buckets gyms in a lat/lng grid to find the nearest one without checking every gym."""
+
+    def __init__(self, gyms, cell_size=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.count = 0
+        for gym in gyms:
+            self.add(gym)
+
+    def _cell(self, latitude, longitude):
+        return int(math.floor(latitude / self.cell_size)), int(math.floor(longitude / self.cell_size))
+
+    def add(self, gym):
+        self.cells.setdefault(self._cell(gym[1], gym[2]), []).append(gym)
+        self.count += 1
+
+    def remove(self, gym):
+        self.cells[self._cell(gym[1], gym[2])].remove(gym)
+        self.count -= 1
+
+    @staticmethod
+    def _ring_cells(row, col, ring):
+        """Cells on the border of the square of side 2 * ring + 1 centered on (row, col)."""
+        if ring == 0:
+            yield row, col
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield row - ring, c
+            yield row + ring, c
+        for r in range(row - ring + 1, row + ring):
+            yield r, col - ring
+            yield r, col + ring
+
+    def nearest(self, latitude, longitude):
+        if not self.count:
+            return None
+        row, col = self._cell(latitude, longitude)
+        cell_width = math.radians(self.cell_size) * EARTH_RADIUS * math.cos(math.radians(latitude))
+        best, best_distance = None, None
+        ring = 0
+        while True:
+            for cell in self._ring_cells(row, col, ring):
+                for gym in self.cells.get(cell, ()):
+                    gym_distance = distance(latitude, longitude, gym[1], gym[2])
+                    if best is None or gym_distance < best_distance:
+                        best, best_distance = gym, gym_distance
+            # Gyms out of the rings already checked are at least ring * cell width away
+            if best is not None and best_distance <= ring * cell_width:
+                return best
+            ring += 1
+
+
+def nearest_neighbour_tour(gyms, start=None):
+    if not gyms:
+        return []
+    index = GridIndex(gyms)
+    current = index.nearest(*start) if start is not None else gyms[0]
+    tour = []
+    while current is not None:
+        index.remove(current)
+        tour.append(current)
+        current = index.nearest(current[1], current[2])
+    return tour
+
+
+def two_opt(tour, window=TWO_OPT_WINDOW, passes=TWO_OPT_PASSES):
+    """Improves the tour reversing segments (of up to `window` gyms) that shorten it."""
+    def d(a, b):
+        return distance(a[1], a[2], b[1], b[2])
+
+    for _ in range(passes):
+        improved = False
+        for i in range(len(tour) - 2):
+            for j in range(i + 2, min(i + window, len(tour) - 1)):
+                a, b, c, e = tour[i], tour[i + 1], tour[j], tour[j + 1]
+                if d(a, c) + d(b, e) < d(a, b) + d(c, e) - 1e-6:
+                    tour[i + 1:j + 1] = reversed(tour[i + 1:j + 1])
+                    improved = True
+        if not improved:
+            break
+    return tour
+
+
+class RoutePlanner(object):
+    """Plans a short tour over the gyms: nearest neighbour over a spatial index plus 2-opt.
+
+    The tour is computed on first use. Gyms added later are inserted where they lengthen it the least.
+    """
+
+    def __init__(self, gyms, max_speed=MAX_TRAVEL_SPEED):
+        self.max_speed = max_speed
+        self.gyms = list(gyms)
+        self._tour = None
+        self._positions = None
+
+    def tour(self):
+        if self._tour is None:
+            self._tour = two_opt(nearest_neighbour_tour(self.gyms))
+            log.info("Planned route over {} gyms ({:.1f} km)".format(len(self._tour), self.length() / 1000))
+        return self._tour
+
+    def position(self, gym_id):
+        """Index of the gym in the tour."""
+        if self._positions is None:
+            self._positions = dict((gym[0], idx) for idx, gym in enumerate(self.tour()))
+        return self._positions[gym_id]
+
+    def add(self, gym):
+        """Inserts a new gym in the tour, between the two consecutive gyms closest to it."""
+        tour = self.tour()
+        self.gyms.append(gym)
+        if len(tour) < 2:
+            tour.append(gym)
+        else:
+            def detour(idx):
+                a, b = tour[idx], tour[idx + 1]
+                return (distance(a[1], a[2], gym[1], gym[2]) + distance(gym[1], gym[2], b[1], b[2]) -
+                        distance(a[1], a[2], b[1], b[2]))
+            tour.insert(min(xrange(len(tour) - 1), key=detour) + 1, gym)
+        self._positions = None
+
+    def length(self):
+        tour = self.tour()
+        return sum(distance(a[1], a[2], b[1], b[2]) for a, b in zip(tour, tour[1:]))
+
+    def sweep_offsets(self, accounts, delay):
+        """Seconds from now at which each gym should be scanned so a sweep follows the tour.
+
+        The tour is split into one leg per account and the legs are walked in parallel.
+        """
+        tour = self.tour()
+        leg_size = int(math.ceil(len(tour) / float(max(accounts, 1)))) or 1
+        offsets = {}
+        for leg_start in range(0, len(tour), leg_size):
+            elapsed = 0
+            previous = None
+            for gym in tour[leg_start:leg_start + leg_size]:
+                if previous is not None:
+                    elapsed += max(delay, travel_time(previous, gym, self.max_speed))
+                offsets[gym[0]] = elapsed
+                previous = (gym[1], gym[2])
+        return offsets
@@ -0,0 +1,131 @@
+# coding: utf-8
+import bisect
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta
+
+from peewee import fn
+
+from config import MIN_GYM_SCAN_INTERVAL, MAX_GYM_STALENESS, GYM_ACTIVITY_WINDOW, GYM_ACTIVITY_REFRESH, \
+    GYM_SCAN_DELAY
+from models import Gym, GymLog
+
+log = logging.getLogger(__name__)
+
+
+def to_timestamp(date):
+    return time.mktime(date.timetuple())
+
+
+class ScanScheduler(object):
+    """Decides which gym to scan next.
+
+    Gyms are kept in a heap keyed by next-due time. Busy gyms (recent GymLog activity or
+    changes seen while scanning) are rescanned more often, but no gym waits longer than
+    max_staleness seconds. Due gyms wait in a ready list, most overdue first, or if a
+    RoutePlanner is given, in tour order: pop_due() walks the tour from where it stopped, so the
+    sessions sweep the city instead of jumping across it. The gyms overdue at startup are also
+    staggered along the tour, one leg per account. Gyms joining the rotation are added to the tour.
+    """
+
+    def __init__(self, gyms, min_interval=MIN_GYM_SCAN_INTERVAL, max_staleness=MAX_GYM_STALENESS,
+                 activity_window=GYM_ACTIVITY_WINDOW, activity_refresh=GYM_ACTIVITY_REFRESH,
+                 route=None, accounts=1, delay=GYM_SCAN_DELAY):
+        self.min_interval = min_interval
+        self.max_staleness = max_staleness
+        self.activity_window = activity_window
+        self.activity_refresh = activity_refresh
+        self.gyms = {}
+        self.activity = {}
+        self.due = {}
+        self.heap = []
+        self.ready = []  # sorted (position, gym_id) of the due gyms
+        self.cursor = 0  # position where the next pop_due() starts
+        self.sequence = 0  # position of the next due gym without route
+        self.activity_refreshed = 0
+        self.route = route
+
+        self.refresh_activity()
+        offsets = route.sweep_offsets(accounts, delay) if route is not None else {}
+        last_checked = dict(Gym.select(Gym.id, Gym.last_checked).tuples())
+        now = time.time()
+        for gym in gyms:
+            gym_id = gym[0]
+            self.gyms[gym_id] = gym
+            checked = last_checked.get(gym_id)
+            due_time = to_timestamp(checked) + self.interval(gym_id) if checked else now
+            if due_time <= now:
+                due_time = now + offsets.get(gym_id, 0)
+            self._push(gym_id, due_time)
+
+    def __len__(self):
+        return len(self.gyms)
+
+    def refresh_activity(self):
+        since = datetime.now() - timedelta(seconds=self.activity_window)
+        query = (GymLog.select(GymLog.gym, fn.COUNT(GymLog.id))
+                 .where(GymLog.timestamp > since)
+                 .group_by(GymLog.gym)
+                 .tuples())
+        self.activity = dict((gym_id, float(count)) for gym_id, count in query)
+        self.activity_refreshed = time.time()
+        log.debug("Loaded activity for {} gyms".format(len(self.activity)))
+
+    def interval(self, gym_id):
+        interval = self.max_staleness / (1.0 + self.activity.get(gym_id, 0))
+        return min(max(interval, self.min_interval), self.max_staleness)
+
+    def _push(self, gym_id, due_time):
+        self.due[gym_id] = due_time
+        heapq.heappush(self.heap, (due_time, gym_id))
+
+    def _position(self, gym_id):
+        if self.route is not None:
+            return self.route.position(gym_id)
+        self.sequence += 1
+        return self.sequence
+
+    def seconds_until_due(self):
+        if self.ready:
+            return 0
+        if not self.heap:
+            return self.max_staleness
+        return max(self.heap[0][0] - time.time(), 0)
+
+    def pop_due(self, limit):
+        """Returns up to `limit` due gyms, following the tour from the last one returned."""
+        if time.time() - self.activity_refreshed > self.activity_refresh:
+            self.refresh_activity()
+
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            due_time, gym_id = heapq.heappop(self.heap)
+            if self.due.get(gym_id) != due_time:  # Stale heap entry
+                continue
+            del self.due[gym_id]
+            bisect.insort(self.ready, (self._position(gym_id), gym_id))
+
+        gyms = []
+        while self.ready and len(gyms) < limit:
+            idx = bisect.bisect_left(self.ready, (self.cursor,))
+            if idx == len(self.ready):  # End of the tour, start over
+                idx = 0
+            position, gym_id = self.ready.pop(idx)
+            self.cursor = position + 1
+            gyms.append(self.gyms[gym_id])
+        return gyms
+
+    def reschedule(self, gym, changed=False):
+        """Schedules the next scan of a gym once its current scan is done. Unknown gyms (dead gyms
+        answering a probe again) join the rotation."""
+        gym_id = gym[0]
+        if gym_id not in self.gyms:
+            self.gyms[gym_id] = gym
+            if self.route is not None:
+                self.route.add(gym)
+                # Positions after the new gym moved one place
+                self.ready = sorted((self.route.position(ready_id), ready_id) for _, ready_id in self.ready)
+        if changed:
+            self.activity[gym_id] = self.activity.get(gym_id, 0) + 1
+        self._push(gym_id, time.time() + self.interval(gym_id))
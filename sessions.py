@@ -0,0 +1,198 @@
+# coding: utf-8
+import logging
+import threading
+from Queue import Queue, Empty
+from time import sleep, time
+
+from pgoapi.exceptions import AuthException, ServerSideRequestThrottlingException
+
+from cells import MapRequest, is_gym
+from config import GYM_SCAN_DELAY, MAX_TRAVEL_SPEED, MAX_REQUEST_RATE
+from metrics import STAGE_LATENCY, REQUESTS, REQUEST_RATE, time_histogram
+from ratelimit import AdaptiveRateController
+from route import distance, task_position, travel_time
+from utils import setup_api
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POSITION = (42.878529, -8.544476, 0)  # Catedral
+
+# Seconds to wait before retrying after a login error
+LOGIN_RETRY_DELAY = 5
+
+
+class LoginFailedException(Exception):
+    pass
+
+
+class ApiSession(object):
+    """Long-lived api session for one account. Logs in once and refreshes the token in place."""
+
+    def __init__(self, auth_service, username, password, position=DEFAULT_POSITION):
+        self.auth_service = auth_service
+        self.username = username
+        self.password = password
+        self.position = position
+        self.api = None
+
+    def login(self):
+        log.info("Logging in with account {}".format(self.username))
+        try:
+            with time_histogram(STAGE_LATENCY, 'login'):
+                self.api = setup_api(self.position, self.auth_service, self.username, self.password)
+        except Exception as e:
+            log.error("Error setting up api: " + str(e))
+            self.api = None
+        if self.api is None:
+            raise LoginFailedException("Error setting up api for {}".format(self.username))
+
+    def ensure_login(self):
+        if self.api is None:
+            self.login()
+            return
+
+        auth_provider = self.api.get_auth_provider()
+        if auth_provider.check_access_token():
+            return
+
+        log.info("Refreshing access token for {}".format(self.username))
+        try:
+            if auth_provider.get_access_token(force_refresh=True):
+                return
+        except AuthException as e:
+            log.warn("Error refreshing token for {}: {}".format(self.username, e))
+        self.login()
+
+    def set_position(self, latitude, longitude):
+        self.position = (latitude, longitude, 0)
+        self.api.set_position(latitude, longitude, 0)
+
+    def get_gym_details(self, gym):
+        gym_id, gym_lat, gym_lng = gym
+        self.set_position(gym_lat, gym_lng)
+        response_dict = self.api.get_gym_details(gym_id=gym_id)
+        if response_dict is None or 'responses' not in response_dict or 'GET_GYM_DETAILS' not in response_dict[
+            "responses"]:
+            log.warn("No GET_GYM_DETAILS in response. Skipping gym...")
+            return None
+        return response_dict["responses"]["GET_GYM_DETAILS"]
+
+    def get_map_objects(self, map_request):
+        """Returns the gym forts of the requested cells."""
+        self.set_position(map_request.latitude, map_request.longitude)
+        cell_ids = list(map_request.cell_ids)
+        response_dict = self.api.get_map_objects(latitude=map_request.latitude, longitude=map_request.longitude,
+                                                 since_timestamp_ms=[0, ] * len(cell_ids), cell_id=cell_ids)
+        if response_dict is None or 'responses' not in response_dict or 'GET_MAP_OBJECTS' not in response_dict[
+            "responses"]:
+            log.warn("No GET_MAP_OBJECTS in response. Skipping cells...")
+            return None
+        forts = []
+        for map_cell in response_dict["responses"]["GET_MAP_OBJECTS"].get('map_cells', []):
+            forts.extend(fort for fort in map_cell.get('forts', []) if is_gym(fort))
+        return forts
+
+
+class SessionPool(object):
+    """Spreads requests across one worker thread per account. Results are collected by the caller's thread.
+
+    Each task goes to the least busy session closest to it. Sessions wait between requests as
+    much as needed to not move faster than max_speed, and each one has its own request rate that
+    adapts to the throttling seen (starting at one request every `delay` seconds).
+    """
+
+    def __init__(self, accounts, delay=GYM_SCAN_DELAY, max_speed=MAX_TRAVEL_SPEED, max_rate=MAX_REQUEST_RATE):
+        self.sessions = [ApiSession(*account) for account in accounts]
+        self.max_speed = max_speed
+        self.rates = [AdaptiveRateController(1.0 / delay if delay else max_rate, max_rate=max_rate)
+                      for _ in self.sessions]
+        self.tasks = [Queue() for _ in self.sessions]
+        self.targets = [session.position for session in self.sessions]
+        self.results = Queue()
+        self.workers = []
+
+    def start(self):
+        for session, tasks, rate in zip(self.sessions, self.tasks, self.rates):
+            worker = threading.Thread(target=self._work, args=(session, tasks, rate),
+                                      name="scanner-" + session.username)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _work(self, session, tasks, rate):
+        try:
+            session.login()
+        except LoginFailedException as e:
+            log.error(str(e))
+
+        last_request = 0
+        while True:
+            task = tasks.get()
+            wait = travel_time(session.position, task, self.max_speed) - (time() - last_request)
+            if wait > 0:
+                sleep(wait)
+            rate.acquire()
+
+            result = None
+            error = None
+            try:
+                session.ensure_login()
+                if isinstance(task, MapRequest):
+                    with time_histogram(STAGE_LATENCY, 'map'):
+                        result = session.get_map_objects(task)
+                else:
+                    with time_histogram(STAGE_LATENCY, 'fetch'):
+                        result = session.get_gym_details(task)
+                rate.on_success()
+                REQUESTS.inc('ok' if result is not None else 'empty')
+            except (LoginFailedException, AuthException) as e:
+                error = "Login failed: " + str(e)
+                REQUESTS.inc('login_error')
+                sleep(LOGIN_RETRY_DELAY)
+            except ServerSideRequestThrottlingException as e:
+                error = "Request throttled: " + str(e)
+                REQUESTS.inc('throttled')
+                rate.on_throttle()
+            except Exception as e:
+                error = "Error getting data from server: " + str(e)
+                REQUESTS.inc('error')
+            REQUEST_RATE.set(rate.rate, session.username)
+            if error is not None:
+                log.error(error)
+            elif result is None:
+                error = "Empty response"
+            last_request = time()
+            self.results.put((task, result, error))
+            tasks.task_done()
+
+    @property
+    def size(self):
+        return len(self.sessions)
+
+    def submit(self, task):
+        """Queues a gym (gym_id, latitude, longitude) to get its details, or a MapRequest."""
+        latitude, longitude = task_position(task)
+
+        def cost(idx):
+            target = self.targets[idx]
+            return self.tasks[idx].qsize(), distance(target[0], target[1], latitude, longitude)
+
+        idx = min(range(len(self.sessions)), key=cost)
+        self.targets[idx] = (latitude, longitude)
+        self.tasks[idx].put(task)
+
+    def get_result(self, timeout=None):
+        """Returns the next (task, result, error) tuple, or None if nothing arrived before the timeout."""
+        try:
+            return self.results.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def scan(self, gyms):
+        """Scans all the gyms and yields the details as soon as they arrive."""
+        for gym in gyms:
+            self.submit(gym)
+        for _ in gyms:
+            gym, gym_detail, _ = self.results.get()
+            if gym_detail is not None:
+                yield gym_detail
@@ -0,0 +1,225 @@
+# coding: utf-8
+"""Local stand-in for the game servers, used to load test the scanner.
+
+Set SIMULATED_GYMS in config.py to make utils.setup_api return a SimulatedApi instead of a real
+pgoapi client, or run this module to scan a simulated city for a while and report throughput.
+"""
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from pgoapi.exceptions import AuthException, ServerSideRequestThrottlingException
+
+import config
+from cells import gym_cell_id
+from synthetic import SyntheticCity
+
+log = logging.getLogger(__name__)
+
+TOKEN_LIFETIME = 30 * 60
+
+_world = None
+_world_lock = threading.Lock()
+
+
+def get_world():
+    global _world
+    with _world_lock:
+        if _world is None:
+            _world = SimulatedWorld(config.SIMULATED_GYMS,
+                                    changes_per_second=config.SIMULATED_CHANGES_PER_SECOND,
+                                    throttle_rate=config.SIMULATED_THROTTLE_RATE,
+                                    auth_failure_rate=config.SIMULATED_AUTH_FAILURE_RATE)
+        return _world
+
+
+class SimulatedWorld(object):
+    """A synthetic city whose gyms keep changing in real time. Shared by every SimulatedApi."""
+
+    def __init__(self, gyms_count, changes_per_second=1.0, throttle_rate=0.0, auth_failure_rate=0.0, seed=0):
+        self.city = SyntheticCity(gyms_count, seed=seed, start_timestamp_ms=int(time.time() * 1000))
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.changes_per_second = changes_per_second
+        self.throttle_rate = throttle_rate
+        self.auth_failure_rate = auth_failure_rate
+        self.last_advance = time.time()
+        self.pending_changes = 0.0
+        self.requests = 0
+
+        self.cells = {}
+        for gym_id, latitude, longitude in self.city.gym_coords():
+            self.cells.setdefault(gym_cell_id(latitude, longitude), []).append(gym_id)
+        log.info("Simulating {} gyms in {} cells".format(len(self.city.gyms), len(self.cells)))
+
+    def gym_coords(self):
+        return self.city.gym_coords()
+
+    def advance(self):
+        """Applies the gym changes that happened since the last request."""
+        now = time.time()
+        self.pending_changes += (now - self.last_advance) * self.changes_per_second
+        self.last_advance = now
+        self.city.clock_ms = int(now * 1000)
+        gym_ids = self.city.gyms.keys()
+        while self.pending_changes >= 1:
+            self.city.change_gym(self.random.choice(gym_ids))
+            self.pending_changes -= 1
+
+    def request(self):
+        """Accounts a request, possibly failing it as throttled."""
+        self.requests += 1
+        self.advance()
+        if self.random.random() < self.throttle_rate:
+            raise ServerSideRequestThrottlingException("Simulated throttling")
+
+    def login(self, username):
+        with self.lock:
+            if self.random.random() < self.auth_failure_rate:
+                raise AuthException("Simulated login failure for {}".format(username))
+
+    def gym_details(self, gym_id):
+        with self.lock:
+            self.request()
+            if gym_id not in self.city.gyms:
+                return {'result': 2}
+            return self.city.gym_detail(gym_id)
+
+    def map_objects(self, cell_ids):
+        with self.lock:
+            self.request()
+            now_ms = self.city.clock_ms
+            map_cells = []
+            for s2_cell_id in cell_ids:
+                forts = []
+                for gym_id in self.cells.get(s2_cell_id, []):
+                    fort = self.city.gym_detail(gym_id)['gym_state']['fort_data']
+                    forts.append(fort)
+                map_cells.append({'s2_cell_id': s2_cell_id, 'current_timestamp_ms': now_ms, 'forts': forts})
+            return {'status': 1, 'map_cells': map_cells}
+
+
+class SimulatedAuthProvider(object):
+    def __init__(self, world, username):
+        self.world = world
+        self.username = username
+        self.expiration = 0
+
+    def user_login(self):
+        self.world.login(self.username)
+        self.expiration = time.time() + TOKEN_LIFETIME
+        return True
+
+    def check_access_token(self):
+        return time.time() < self.expiration
+
+    def get_access_token(self, force_refresh=False):
+        if force_refresh or not self.check_access_token():
+            self.user_login()
+        return "simulated-token"
+
+
+class SimulatedApi(object):
+    """Implements the subset of pgoapi.PGoApi used by the scanner against the SimulatedWorld."""
+
+    def __init__(self, world=None):
+        self.world = world or get_world()
+        self.auth_provider = None
+        self.position = (0, 0, 0)
+
+    def set_position(self, latitude, longitude, altitude):
+        self.position = (latitude, longitude, altitude)
+
+    def set_authentication(self, provider=None, username=None, password=None, **kwargs):
+        self.auth_provider = SimulatedAuthProvider(self.world, username)
+        self.auth_provider.user_login()
+
+    def activate_signature(self, lib_path):
+        pass
+
+    def get_auth_provider(self):
+        return self.auth_provider
+
+    def _check_login(self):
+        if self.auth_provider is None or not self.auth_provider.check_access_token():
+            raise AuthException("Not logged in")
+
+    def get_gym_details(self, gym_id, **kwargs):
+        self._check_login()
+        return {'status_code': 1, 'responses': {'GET_GYM_DETAILS': self.world.gym_details(gym_id)}}
+
+    def get_map_objects(self, cell_id, **kwargs):
+        self._check_login()
+        return {'status_code': 1, 'responses': {'GET_MAP_OBJECTS': self.world.map_objects(cell_id)}}
+
+
+def main():
+    from cells import CellScheduler
+    from city_state import CityState
+    from gyms_scanner import scan_loop
+    from models import create_tables, use_database
+    from ratelimit import RetryQueue
+    from scheduler import ScanScheduler
+    from sessions import SessionPool
+
+    parser = argparse.ArgumentParser(description="Scan a simulated city and report the scanner throughput")
+    parser.add_argument('--gyms', type=int, default=10000)
+    parser.add_argument('--accounts', type=int, default=4)
+    parser.add_argument('--duration', type=int, default=60, help="seconds to scan")
+    parser.add_argument('--mode', choices=['details', 'cells'], default='details')
+    parser.add_argument('--delay', type=float, default=0, help="delay between scans of each account")
+    parser.add_argument('--max-rate', type=float, default=100, help="max requests/s of each account")
+    parser.add_argument('--max-speed', type=float, default=0, help="max travel speed (m/s) of each account")
+    parser.add_argument('--changes-per-second', type=float, default=20)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--auth-failure-rate', type=float, default=0.0)
+    parser.add_argument('--database', help="SQLite file to use (default: temporary file)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    config.SIMULATED_GYMS = args.gyms
+    config.SIMULATED_CHANGES_PER_SECOND = args.changes_per_second
+    config.SIMULATED_THROTTLE_RATE = args.throttle_rate
+    config.SIMULATED_AUTH_FAILURE_RATE = args.auth_failure_rate
+    # The sessions import this module as `simulator`, not `__main__`: use its world, the one they scan
+    import simulator
+    world = simulator.get_world()
+
+    tmp_dir = None
+    database = args.database
+    if database is None:
+        tmp_dir = tempfile.mkdtemp(prefix='simulator')
+        database = os.path.join(tmp_dir, 'simulator.sqlite')
+    try:
+        use_database(database)
+        create_tables()
+        state = CityState.load()
+        if args.mode == 'cells':
+            scheduler = CellScheduler(world.gym_coords(), state)
+        else:
+            scheduler = ScanScheduler(world.gym_coords(), min_interval=0)
+        pool = SessionPool([('ptc', 'simulated{}'.format(idx), '') for idx in range(args.accounts)],
+                           args.delay, args.max_speed, args.max_rate)
+        pool.start()
+
+        timings = {}
+        start = time.time()
+        scanned = scan_loop(pool, scheduler, state, retry_queue=RetryQueue(path=None), duration=args.duration,
+                            timings=timings)
+        elapsed = time.time() - start
+        print "Scanned {} gyms in {:.1f}s ({:.1f} gyms/s, {} requests to the server)".format(
+            scanned, elapsed, scanned / elapsed, world.requests)
+        for stage in sorted(timings):
+            print "  {:6} {:.3f}s".format(stage, timings[stage])
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
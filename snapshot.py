@@ -0,0 +1,141 @@
+# coding: utf-8
+"""Versioned, pre-serialized snapshot of the gyms for the web map.
+
+The scanner keeps every gym serialized in memory, updates the modified ones after each batch and
+publishes them to GYMS_SNAPSHOT_FILE together with the ids changed by each recent version.
+Versions are unix timestamps (strictly increasing), so they double as the map's update time.
+The web server loads the file when it changes and renders, once per version, the response to
+/gyms?after=<version> for every retained version.
+"""
+import calendar
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from email.utils import formatdate
+
+from peewee import fn
+
+from config import GYMS_SNAPSHOT_FILE, SNAPSHOT_INTERVAL, SNAPSHOT_DELTAS
+from models import Gym, GymMember, serialize_gym
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), GYMS_SNAPSHOT_FILE)
+
+
+def encode_datetime(value):
+    """Same format as Flask's jsonify (RFC 822, GMT)."""
+    if isinstance(value, datetime):
+        return formatdate(calendar.timegm(value.utctimetuple()), usegmt=True)
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def dumps(data):
+    return json.dumps(data, default=encode_datetime, separators=(',', ':'))
+
+
+class GymSnapshot(object):
+    """Scanner side: the serialized gyms and the ids changed by each of the last max_deltas versions."""
+
+    def __init__(self, path=SNAPSHOT_PATH, interval=SNAPSHOT_INTERVAL, max_deltas=SNAPSHOT_DELTAS):
+        self.path = path
+        self.interval = interval
+        self.max_deltas = max_deltas
+        self.gyms = {}
+        self.version = 0
+        self.deltas = []  # [(version, [gym ids])], oldest first
+        self.pending = set()
+        self.published = 0
+
+    @classmethod
+    def load(cls, **kwargs):
+        snapshot = cls(**kwargs)
+        members_count = dict(GymMember.select(GymMember.gym, fn.COUNT(GymMember.id)).group_by(GymMember.gym)
+                             .tuples())
+        for gym in Gym.select().dicts():
+            snapshot.gyms[gym['id']] = serialize_gym(gym, members_count.get(gym['id'], 0))
+        snapshot.version = int(time.time())
+        snapshot.deltas.append((snapshot.version, []))
+        snapshot.publish()
+        return snapshot
+
+    def update(self, gyms, gym_members, trainers, pokemons):
+        """Takes the modified gyms of a batch (as returned by parse_gym_details)."""
+        for gym_id, gym in gyms.iteritems():
+            self.gyms[gym_id] = serialize_gym(gym, len(gym_members[gym_id]))
+            self.pending.add(gym_id)
+
+    def publish_if_due(self):
+        if self.pending and time.time() - self.published >= self.interval:
+            self.publish()
+
+    def publish(self):
+        if self.pending:
+            self.version = max(self.version + 1, int(time.time()))
+            self.deltas.append((self.version, sorted(self.pending)))
+            self.deltas = self.deltas[-self.max_deltas:]
+            self.pending = set()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write(dumps({'version': self.version, 'gyms': self.gyms, 'deltas': self.deltas}))
+        os.rename(tmp_path, self.path)
+        self.published = time.time()
+        log.debug("Published gyms snapshot version {}".format(self.version))
+
+
+class SnapshotReader(object):
+    """Web side: answers /gyms?after= from the last published snapshot, reloaded when the file changes."""
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        self.mtime = None
+        self.version = 0
+        self.responses = {}  # after version -> json body
+        self.full_response = dumps({'timestamp': 0, 'gyms': []})
+        self.lock = threading.Lock()
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            with open(self.path) as fp:
+                data = json.load(fp)
+            self.render(data)
+            self.mtime = mtime
+        log.info("Loaded gyms snapshot version {}".format(self.version))
+
+    def render(self, data):
+        # Gyms are decoded once and embedded as they are, so each one is encoded once per version
+        version = data['version']
+        gyms = dict((gym_id, json.dumps(gym, separators=(',', ':'))) for gym_id, gym in data['gyms'].iteritems())
+        responses = {}
+        changed = set()
+        previous_versions = [delta_version for delta_version, _ in data['deltas']][:-1]
+        for (delta_version, gym_ids), after in reversed(zip(data['deltas'], [None] + previous_versions)):
+            changed.update(gym_ids)
+            if after is not None:
+                responses[after] = self._body(version, [gyms[gym_id] for gym_id in changed if gym_id in gyms])
+        responses[version] = self._body(version, [])
+        self.full_response = self._body(version, gyms.values())
+        self.responses = responses
+        self.version = version
+
+    @staticmethod
+    def _body(version, serialized_gyms):
+        return '{{"timestamp":{},"gyms":[{}]}}'.format(version, ','.join(serialized_gyms))
+
+    def get(self, after=0):
+        """Returns the json body with the gyms changed since version `after` (all of them if unknown)."""
+        self.reload()
+        if after >= self.version and after:
+            return '{{"timestamp":{},"gyms":[]}}'.format(after)
+        return self.responses.get(after, self.full_response)
@@ -0,0 +1,152 @@
+# coding: utf-8
+import random
+
+from models import Gym, gym_level
+
+CENTER = (42.878529, -8.544476)  # Catedral
+
+
+class SyntheticCity(object):
+    """Generates GET_GYM_DETAILS responses for a fake city and makes its gyms change over time."""
+
+    TEAMS = [Gym.TEAM_MYSTIC, Gym.TEAM_VALOR, Gym.TEAM_INSTINCT]
+
+    def __init__(self, gyms_count, trainers_count=None, seed=0, center=CENTER, radius=0.05,
+                 start_timestamp_ms=1470000000000):
+        self.random = random.Random(seed)
+        self.clock_ms = start_timestamp_ms
+        self.next_pokemon_id = 1
+
+        trainers_count = trainers_count or gyms_count * 5
+        self.trainers = {}
+        self.trainers_by_team = dict((team_id, []) for team_id in self.TEAMS)
+        for idx in range(trainers_count):
+            name = "Trainer{}".format(idx)
+            team_id = self.random.choice(self.TEAMS)
+            self.trainers[name] = {'name': name, 'level': self.random.randint(5, 30), 'team_id': team_id}
+            self.trainers_by_team[team_id].append(name)
+
+        self.gyms = {}
+        for idx in range(gyms_count):
+            gym_id = "{:032x}.16".format(self.random.getrandbits(128))
+            self.gyms[gym_id] = {
+                'id': gym_id,
+                'name': u"Gym {}".format(idx),
+                'latitude': center[0] + self.random.uniform(-radius, radius),
+                'longitude': center[1] + self.random.uniform(-radius, radius),
+                'team_id': Gym.UNCONTESTED,
+                'gym_points': 0,
+                'guard_pokemon_id': 0,
+                'is_in_battle': False,
+                'last_modified_timestamp_ms': self.clock_ms,
+                'members': [],
+            }
+            self._conquest(self.gyms[gym_id], self.random.choice(self.TEAMS))
+            for _ in range(self.random.randint(0, 4)):
+                self._train(self.gyms[gym_id])
+
+    def gym_coords(self):
+        return [(gym['id'], gym['latitude'], gym['longitude']) for gym in self.gyms.itervalues()]
+
+    def _new_pokemon(self, trainer_name):
+        pokemon = {
+            'id': self.next_pokemon_id,
+            'owner_name': trainer_name,
+            'pokemon_id': self.random.randint(1, 151),
+            'cp': self.random.randint(10, 3000),
+        }
+        self.next_pokemon_id += 1
+        return pokemon
+
+    def _touch(self, gym):
+        gym['last_modified_timestamp_ms'] = self.clock_ms
+
+    def _conquest(self, gym, team_id):
+        gym['team_id'] = team_id
+        gym['gym_points'] = 0
+        gym['members'] = []
+        self._join(gym)
+
+    def _join(self, gym):
+        if gym['team_id'] == Gym.UNCONTESTED or len(gym['members']) >= gym_level(gym['gym_points']):
+            return
+        in_gym = set(trainer_name for trainer_name, _ in gym['members'])
+        candidates = self.trainers_by_team[gym['team_id']]
+        for _ in range(10):
+            trainer_name = self.random.choice(candidates)
+            if trainer_name not in in_gym:
+                pokemon = self._new_pokemon(trainer_name)
+                gym['members'].append((trainer_name, pokemon))
+                gym['guard_pokemon_id'] = pokemon['pokemon_id']
+                return
+
+    def _leave(self, gym):
+        if gym['members']:
+            gym['members'].pop(self.random.randrange(len(gym['members'])))
+        if not gym['members']:
+            gym['team_id'] = Gym.UNCONTESTED
+            gym['gym_points'] = 0
+
+    def _train(self, gym):
+        if gym['team_id'] != Gym.UNCONTESTED:
+            gym['gym_points'] = min(gym['gym_points'] + self.random.randint(100, 1500), 52000)
+            self._join(gym)
+
+    def _attack(self, gym):
+        gym['is_in_battle'] = True
+        gym['gym_points'] = max(gym['gym_points'] - self.random.randint(100, 3000), 0)
+        while len(gym['members']) > gym_level(gym['gym_points']):
+            self._leave(gym)
+        if gym['gym_points'] == 0:
+            self._conquest(gym, self.random.choice(self.TEAMS))
+
+    def change_gym(self, gym_id):
+        """Applies a random event (training, battle, join, leave...) to a gym."""
+        gym = self.gyms[gym_id]
+        if gym['is_in_battle'] and self.random.random() < 0.5:
+            gym['is_in_battle'] = False
+        else:
+            self.random.choice([self._train, self._attack, self._join, self._leave])(gym)
+        self._touch(gym)
+
+    def step(self, seconds=60, churn=0.1):
+        """Advances the clock and changes a fraction of the gyms. Returns the changed gym ids."""
+        self.clock_ms += int(seconds * 1000)
+        changed = self.random.sample(self.gyms.keys(), int(len(self.gyms) * churn))
+        for gym_id in changed:
+            self.change_gym(gym_id)
+        return changed
+
+    def gym_detail(self, gym_id):
+        gym = self.gyms[gym_id]
+        fort_data = {
+            'id': gym['id'],
+            'enabled': True,
+            'latitude': gym['latitude'],
+            'longitude': gym['longitude'],
+            'gym_points': gym['gym_points'],
+            'guard_pokemon_id': gym['guard_pokemon_id'],
+            'is_in_battle': gym['is_in_battle'],
+            'last_modified_timestamp_ms': gym['last_modified_timestamp_ms'],
+            'type': 0,
+        }
+        if gym['team_id'] != Gym.UNCONTESTED:
+            fort_data['owned_by_team'] = gym['team_id']
+
+        memberships = []
+        for trainer_name, pokemon in gym['members']:
+            trainer = self.trainers[trainer_name]
+            memberships.append({
+                'pokemon_data': dict(pokemon),
+                'trainer_public_profile': {'name': trainer_name, 'level': trainer['level']},
+            })
+
+        return {
+            'result': 1,
+            'name': gym['name'],
+            'description': u"",
+            'gym_state': {'fort_data': fort_data, 'memberships': memberships},
+        }
+
+    def gym_details(self, gym_ids=None):
+        return [self.gym_detail(gym_id) for gym_id in (gym_ids if gym_ids is not None else self.gyms)]
@@ -0,0 +1,112 @@
+# coding: utf-8
+"""Case-insensitive prefix and typo-tolerant lookup of trainer names."""
+import bisect
+import threading
+from collections import Counter, defaultdict
+
+MAX_DISTANCE = 2
+MAX_CANDIDATES = 30
+
+
+def trigrams(text):
+    padded = u'^{}$'.format(text)
+    return set(padded[idx:idx + 3] for idx in range(max(len(padded) - 2, 1)))
+
+
+def edit_distance(a, b, limit=MAX_DISTANCE):
+    """Levenshtein distance between a and b, or limit + 1 if it is greater than limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = range(len(b) + 1)
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class TrainerIndex(object):
+    """Index of trainer names: sorted lowercase names for prefixes and a trigram index for typos.
+
+    Trainers are never removed from the live state, so refresh() only adds the names it has not
+    seen yet. The lookups hold the lock, as the bot handlers run in several threads.
+    """
+
+    def __init__(self):
+        self.names = defaultdict(list)  # lowercase name -> names
+        self.sorted_names = []  # sorted lowercase names
+        self.trigrams = defaultdict(set)  # trigram -> lowercase names
+        self.size = 0
+        self.lock = threading.Lock()  # Held while reading or changing the index
+        self.refresh_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        key = name.lower()
+        if name in self.names.get(key, ()):
+            return
+        if key not in self.names:
+            bisect.insort(self.sorted_names, key)
+            for trigram in trigrams(key):
+                self.trigrams[trigram].add(key)
+        self.names[key].append(name)
+
+    def refresh(self, state):
+        """Adds the trainers of a LiveState that are not indexed yet.
+
+        The live state is sorted by name, so new trainers can be anywhere: every name is read when
+        the number of trainers changes, but the lookups only wait while the new ones are added.
+        """
+        with self.refresh_lock:
+            if state.trainers_count == self.size:
+                return
+            # Only refresh() changes the index, so it can be read without the lock here
+            new_names = [name for name in (state.trainer_name_at(idx) for idx in xrange(state.trainers_count))
+                         if name not in self.names.get(name.lower(), ())]
+            with self.lock:
+                for name in new_names:
+                    self.add(name)
+            self.size = state.trainers_count
+
+    def exact(self, query):
+        """Names equal to the query ignoring case."""
+        with self.lock:
+            return list(self.names.get(query.lower(), ()))
+
+    def prefix(self, query, limit=5):
+        key = query.lower()
+        result = []
+        with self.lock:
+            idx = bisect.bisect_left(self.sorted_names, key)
+            while idx < len(self.sorted_names) and self.sorted_names[idx].startswith(key) and len(result) < limit:
+                result.extend(self.names[self.sorted_names[idx]])
+                idx += 1
+        return result[:limit]
+
+    def similar(self, query, limit=5, max_distance=MAX_DISTANCE):
+        """Names within max_distance edits of the query, closest first."""
+        key = query.lower()
+        shared = Counter()
+        with self.lock:
+            for trigram in trigrams(key):
+                shared.update(self.trigrams.get(trigram, ()))
+        matches = []
+        for candidate, _ in shared.most_common(MAX_CANDIDATES):
+            distance = edit_distance(key, candidate, max_distance)
+            if distance <= max_distance:
+                matches.append((distance, candidate))
+        with self.lock:
+            return [name for _, candidate in sorted(matches) for name in self.names[candidate]][:limit]
+
+    def suggestions(self, query, limit=5):
+        """Prefix matches first, then similar names."""
+        result = self.prefix(query, limit)
+        for name in self.similar(query, limit):
+            if name not in result:
+                result.append(name)
+        return result[:limit]
@@ -2,12 +2,19 @@ import logging
 import os
 import platform
 import sys
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
 from pgoapi import pgoapi
 
+import config
+from metrics import STAGE_LATENCY
+
 log = logging.getLogger(__name__)
 
+_encryption_lib_path = None
+
 
 def setup_logging():
     # log settings
@@ -24,21 +31,46 @@ def setup_logging():
 
 
 def setup_api(position, auth_service, username, password):
-    api = pgoapi.PGoApi()
+    if config.SIMULATED_GYMS:
+        from simulator import SimulatedApi
+        api = SimulatedApi()
+    else:
+        api = pgoapi.PGoApi()
     api.set_position(*position)
 
     api.set_authentication(provider=auth_service, username=username, password=password)
 
-    api.activate_signature(get_encryption_lib_path())
+    if not config.SIMULATED_GYMS:  # The simulated server does not need the native encryption library
+        api.activate_signature(get_encryption_lib_path())
 
     return api
 
 
+@contextmanager
+def timed(timings, stage):
+    """Adds the seconds spent in the block to timings[stage] (if timings is not None) and to the stage metrics."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        STAGE_LATENCY.observe(elapsed, stage)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0) + elapsed
+
+
 def timestamp_to_strftime(timestamp):
     return datetime.fromtimestamp(int(timestamp) / 1000).strftime('%Y-%m-%d %H:%M:%S')
 
 
 def get_encryption_lib_path():
+    global _encryption_lib_path
+    if _encryption_lib_path is None:
+        _encryption_lib_path = find_encryption_lib_path()
+    return _encryption_lib_path
+
+
+def find_encryption_lib_path():
     # win32 doesn't mean necessarily 32 bits
     if sys.platform == "win32" or sys.platform == "cygwin":
         if platform.architecture()[0] == '64bit':
@@ -1,12 +1,15 @@
 import logging
-import time
 from datetime import datetime
 
-from flask import Flask, jsonify
+from flask import Flask, jsonify, abort
 from flask.globals import request
 from flask.templating import render_template
 
-from models import Gym
+import analytics
+from history import state_at
+from livestate import LiveStateReader
+from models import init_database, gym_level
+from snapshot import SnapshotReader
 
 logging.basicConfig(format='%(asctime)s [%(module)10s] [%(levelname)5s] %(message)s')
 logging.getLogger("peewee").setLevel(logging.INFO)
@@ -14,6 +17,8 @@ log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
 app = Flask(__name__)
+snapshot = SnapshotReader()
+live_state = LiveStateReader()
 
 
 @app.route('/')
@@ -23,18 +28,50 @@ def index():
 
 @app.route('/gyms')
 def gyms():
-    timestamp = int(request.args.get('after', 0))
-    gyms = Gym.select().where(Gym.last_updated > datetime.fromtimestamp(timestamp + 1))
-    last_updated = 0
+    # Answered from the snapshot published by the scanner: no queries nor serialization per request
+    try:
+        timestamp = int(request.args.get('after', 0))
+    except ValueError:
+        abort(400)
+    log.debug("Gyms: timestamp=%d version=%d" % (timestamp, snapshot.version))
+    return app.response_class(snapshot.get(timestamp), mimetype='application/json')
 
-    log.debug("Gyms: timestamp=%d %d" % (timestamp, len(gyms)))
 
-    for gym in gyms:
-        last_updated = max(last_updated, int(time.mktime(gym.last_updated.timetuple())))
+@app.route('/gyms/at')
+def gyms_at():
+    """State of the gyms at ?timestamp= (unix seconds), rebuilt from the nearest checkpoint."""
+    try:
+        timestamp = int(request.args.get('timestamp', 0))
+        moment = datetime.fromtimestamp(timestamp)
+    except (ValueError, OverflowError):
+        abort(400)
+    gyms = state_at(moment)
+    current = live_state.get()
+    if gyms is None or current is None:
+        abort(404)
+    response = []
+    for live_gym in current.gyms():
+        gym = gyms.get(live_gym.id)
+        if gym is None:
+            continue
+        data = gym.serialize()
+        data.update(id=live_gym.id, name=live_gym.name, latitude=live_gym.latitude, longitude=live_gym.longitude,
+                    level=gym_level(gym.gym_points))
+        response.append(data)
+    return jsonify(timestamp=timestamp, gyms=response)
 
-    if not gyms:
-        last_updated = timestamp
-    return jsonify(timestamp=last_updated, gyms=[gym.serialize() for gym in gyms])
 
+@app.route('/analytics')
+def city_analytics():
+    try:
+        days = int(request.args.get('days', 30))
+        step = int(request.args.get('step', 60 * 60))
+    except ValueError:
+        abort(400)
+    if not analytics.valid_range(days, step):
+        abort(400)
+    return jsonify(**analytics.summary(days=days, step=step))
 
-app.run(debug=True)
+
+init_database(read_only=True)
+app.run(debug=True, threaded=True)